@@ -0,0 +1,499 @@
+"""Микробенчмарки горячих мест бота: было/стало для каждой оптимизации.
+
+Прежние реализации воспроизведены здесь же как эталон, текущие берутся
+из main.py. Каждый режим запускается отдельно и работает на временной БД.
+
+    python bench.py db --ops 2000
+    python bench.py codes --occupancy 0.5 0.9 0.95 0.99
+    python bench.py inline --answers 20000
+    python bench.py ui --renders 20000
+    python bench.py startup --users 1000000
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import sqlite3
+import string
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+
+import aiosqlite
+from aiogram.methods import AnswerInlineQuery, EditMessageText
+from aiogram.types import InlineKeyboardButton, InlineQueryResultArticle, InputTextMessageContent, User
+from aiogram.utils.keyboard import InlineKeyboardBuilder
+
+
+def load_main(db_name: str):
+    os.environ.setdefault("BOT_TOKEN", "123456:bench")
+    os.environ.setdefault("ADMIN_ID", "1")
+    os.environ.setdefault("BOT_USERNAME", "bench_bot")
+    # Гистограммы вокруг каждого вызова БД исказили бы замер
+    os.environ["METRICS_ENABLED"] = "0"
+    os.environ["DB_NAME"] = db_name
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main
+    return main
+
+
+def report(title: str, before: float, after: float, unit: str = "оп/с"):
+    print(f"  {title:<32} {before:>10.0f} -> {after:>10.0f} {unit}  (x{after / before:.1f})")
+
+
+async def timed(ops: int, coro_factory, concurrency: int = 1) -> float:
+    limit = asyncio.Semaphore(concurrency)
+
+    async def one(i: int):
+        async with limit:
+            await coro_factory(i)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(ops)))
+    return ops / (time.perf_counter() - started)
+
+
+# ------------------- db: пул соединений (было: aiosqlite.connect на каждый вызов) -------------------
+async def legacy_add_balance(path: str, user_id: int, amount: int):
+    async with aiosqlite.connect(path) as db:
+        await db.execute("INSERT OR IGNORE INTO users (user_id, balance) VALUES (?, 0)", (user_id,))
+        await db.execute("UPDATE users SET balance = balance + ? WHERE user_id = ?", (amount, user_id))
+        await db.commit()
+
+
+async def legacy_get_user_data(path: str, user_id: int):
+    async with aiosqlite.connect(path) as db:
+        async with db.execute("SELECT balance, payment_method, payment_number, payment_bank FROM users WHERE user_id = ?", (user_id,)) as cursor:
+            return await cursor.fetchone()
+
+
+async def bench_db(args):
+    workdir = tempfile.mkdtemp()
+    main = load_main(os.path.join(workdir, "after.db"))
+    legacy_path = os.path.join(workdir, "before.db")
+    async with aiosqlite.connect(legacy_path) as db:
+        await db.execute(
+            "CREATE TABLE users (user_id INTEGER PRIMARY KEY, balance INTEGER DEFAULT 0, "
+            "payment_method TEXT, payment_number TEXT, payment_bank TEXT)"
+        )
+        await db.commit()
+    await main.init_db()
+
+    # Тот же SQL, что и в прежних хелперах: сравнивается только слой соединений
+    async def pooled_add_balance(user_id: int, amount: int):
+        async with main.db_pool.write() as db:
+            await db.execute("INSERT OR IGNORE INTO users (user_id, balance) VALUES (?, 0)", (user_id,))
+            await db.execute("UPDATE users SET balance = balance + ? WHERE user_id = ?", (amount, user_id))
+
+    users = args.users
+    print(f"db: {args.ops} операций на {users} пользователях")
+    report(
+        "add_balance, подряд",
+        await timed(args.ops, lambda i: legacy_add_balance(legacy_path, i % users, 1), 1),
+        await timed(args.ops, lambda i: pooled_add_balance(i % users, 1), 1),
+    )
+    report(
+        f"add_balance, по {args.concurrency}",
+        await timed(args.ops, lambda i: legacy_add_balance(legacy_path, i % users, 1), args.concurrency),
+        await timed(args.ops, lambda i: pooled_add_balance(i % users, 1), args.concurrency),
+    )
+    # load_user_data - чтение через пул без кэша профилей
+    report(
+        "get_user_data, подряд",
+        await timed(args.ops, lambda i: legacy_get_user_data(legacy_path, i % users), 1),
+        await timed(args.ops, lambda i: main.load_user_data(i % users), 1),
+    )
+    report(
+        f"get_user_data, по {args.concurrency}",
+        await timed(args.ops, lambda i: legacy_get_user_data(legacy_path, i % users), args.concurrency),
+        await timed(args.ops, lambda i: main.load_user_data(i % users), args.concurrency),
+    )
+    await main.db_pool.close()
+
+
+# ------------------- codes: выдача кодов оплаты (было: random.choices до свободного кода) -------------------
+def legacy_generate_code(active_sessions: dict, length: int) -> str:
+    while True:
+        code = "".join(random.choices(string.digits, k=length))
+        if code not in active_sessions:
+            return code
+
+
+async def bench_codes(args):
+    main = load_main(os.path.join(tempfile.mkdtemp(), "codes.db"))
+    length = main.CODE_LENGTH
+    capacity = 10 ** length
+    print(f"codes: выдача + возврат кода, {args.ops} раз при заданной занятости {capacity} коротких кодов")
+    for occupancy in args.occupancy:
+        taken = int(capacity * occupancy)
+
+        active_sessions = {}
+        while len(active_sessions) < taken:
+            active_sessions[legacy_generate_code(active_sessions, length)] = {"user_id": 0}
+        started = time.perf_counter()
+        for _ in range(args.ops):
+            code = legacy_generate_code(active_sessions, length)
+            active_sessions[code] = {"user_id": 0}
+            del active_sessions[code]
+        before = args.ops / (time.perf_counter() - started)
+
+        # Порог длинных кодов выше занятости: меряем именно пул коротких
+        allocator = main.CodeAllocator(length, main.CODE_TTL, main.LONG_CODE_LENGTH, 1.0)
+        for _ in range(taken):
+            allocator.allocate({"user_id": 0})
+        started = time.perf_counter()
+        for _ in range(args.ops):
+            allocator.release(allocator.allocate({"user_id": 0}))
+        after = args.ops / (time.perf_counter() - started)
+        report(f"занято {occupancy:.0%}", before, after)
+
+    # Всё занято: прежний цикл не вернулся бы никогда, аллокатор переходит на длинные коды
+    allocator = main.CodeAllocator(length, main.CODE_TTL, main.LONG_CODE_LENGTH, main.LONG_CODE_THRESHOLD)
+    for _ in range(capacity):
+        allocator.allocate({"user_id": 0})
+    started = time.perf_counter()
+    for _ in range(args.ops):
+        allocator.release(allocator.allocate({"user_id": 0}))
+    print(f"  занято 100%: было - бесконечный цикл, стало {args.ops / (time.perf_counter() - started):.0f} оп/с (длинные коды)")
+
+    started = time.perf_counter()
+    expired = sum(allocator.sweep() for _ in range(len(allocator.wheel)))
+    print(f"  полный оборот колеса TTL: {expired} кодов за {(time.perf_counter() - started) * 1000:.1f} мс")
+
+
+# ------------------- inline: ответы на inline-запросы (было: сборка результата с нуля) -------------------
+class FakeInlineQuery:
+    """Запрос, ответ на который собирается в AnswerInlineQuery, но не уходит в сеть."""
+
+    ids = itertools.count()
+
+    def __init__(self, amount: int, user_id: int):
+        self.id = str(next(self.ids))
+        self.query = str(amount)
+        self.from_user = User(id=user_id, is_bot=False, first_name="bench")
+
+    async def answer(self, results, **kwargs):
+        return AnswerInlineQuery(inline_query_id=self.id, results=results, **kwargs)
+
+
+async def legacy_inline_query_handler(query, bot_username: str):
+    amount_str = query.query.strip()
+    if not amount_str.isdigit():
+        return
+    amount = int(amount_str)
+    if amount <= 0 or amount > 10000:
+        return
+    merchant_id = query.from_user.id
+    unique_link_id = uuid.uuid4().hex[:12]
+    text = f"оплатите счёт на {amount} stars <tg-emoji emoji-id=\"5384159397263990339\">⭐</tg-emoji>"
+    start_param = f"inline_pay_{amount}_{merchant_id}_{unique_link_id}"
+    kb = InlineKeyboardBuilder()
+    kb.row(InlineKeyboardButton(text="оплатить", url=f"https://t.me/{bot_username}?start={start_param}"))
+    results = [
+        InlineQueryResultArticle(
+            id=str(uuid.uuid4()),
+            title=f"отправить счёт на {amount} stars",
+            description="нажмите чтобы создать и отправить счёт пользователю",
+            input_message_content=InputTextMessageContent(message_text=text, parse_mode="HTML"),
+            reply_markup=kb.as_markup(),
+            thumb_url="https://files.catbox.moe/5uy724.png",
+            thumb_width=512,
+            thumb_height=512
+        )
+    ]
+    await query.answer(results, cache_time=1)
+
+
+async def bench_inline(args):
+    # Дебаунс - это ожидание, а не работа; пул ссылок меряется отдельной строкой
+    os.environ["INLINE_DEBOUNCE"] = "0"
+    os.environ["INLINE_DIRECT_LINKS"] = "0"
+    main = load_main(os.path.join(tempfile.mkdtemp(), "inline.db"))
+    queries = [FakeInlineQuery(random.randint(1, args.amounts), random.randint(1, 1000)) for _ in range(args.answers)]
+    print(f"inline: {args.answers} ответов, суммы 1..{args.amounts}, без сети")
+
+    async def answers_per_second(handler) -> float:
+        started = time.perf_counter()
+        for query in queries:
+            await handler(query)
+        return len(queries) / (time.perf_counter() - started)
+
+    before = await answers_per_second(lambda query: legacy_inline_query_handler(query, main.BOT_USERNAME))
+    main.inline_invoice_template.cache_clear()
+    report("ссылка через /start", before, await answers_per_second(main.inline_query_handler), "отв/с")
+
+    # Прямые ссылки: постоянные продавцы с повторяющимися суммами, пул прогрет одним проходом;
+    # за проход каждая пара запрашивается столько раз, сколько ссылок держит её пул.
+    # createInvoiceLink подменён, в замер попадают выдача из пула и фоновое пополнение с записью в SQLite
+    links = itertools.count()
+    claimed = []
+    claim = main.invoice_link_pool._claim
+
+    async def create_invoice_link(**kwargs):
+        return f"https://t.me/$bench{next(links)}"
+
+    async def counting_claim(key: tuple):
+        url = await claim(key)
+        claimed.append(url is not None)
+        return url
+
+    main.bot.create_invoice_link = create_invoice_link
+    main.invoice_link_pool._claim = counting_claim
+    main.INLINE_DIRECT_LINKS = True
+    await main.init_db()
+    queries = [
+        FakeInlineQuery(amount, merchant_id)
+        for merchant_id in range(1, args.merchants + 1)
+        for amount in range(100, 1100, 100)
+        for _ in range(main.INVOICE_LINK_POOL)
+    ]
+    random.shuffle(queries)
+
+    async def drain_refills():
+        while main.background_tasks:
+            await asyncio.gather(*main.background_tasks)
+
+    await answers_per_second(main.inline_query_handler)
+    await drain_refills()
+    claimed.clear()
+    direct = await answers_per_second(main.inline_query_handler)
+    await drain_refills()
+    print(f"  {'прямая ссылка из пула':<32} {direct:>10.0f} отв/с  (из пула {sum(claimed)} из {len(claimed)})")
+    await main.db_pool.close()
+
+
+# ------------------- ui: отрисовка профиля и меню (было: InlineKeyboardBuilder на каждый апдейт) -------------------
+class FakeMessage:
+    """Сообщение, правка которого собирается в EditMessageText, но не уходит в сеть."""
+
+    def __init__(self):
+        self.edits = []  # Держим отправленное: иначе текст и клавиатура освобождаются до снимка памяти
+
+    async def edit_text(self, text, **kwargs):
+        self.edits.append(EditMessageText(chat_id=1, message_id=1, text=text, **kwargs))
+
+
+async def legacy_main_menu_kb(user_id):
+    builder = InlineKeyboardBuilder()
+    builder.row(InlineKeyboardButton(text="📥 принять оплату", callback_data="receive_payment"))
+    builder.row(InlineKeyboardButton(text="💸 оплатить", callback_data="make_payment"))
+    builder.row(InlineKeyboardButton(text="👤 профиль", callback_data="open_profile"))
+    return builder.as_markup()
+
+
+async def legacy_show_profile(main, message, user_id: int):
+    user_data = await main.get_user_data(user_id)
+    if not user_data:
+        balance = 0
+        p_method, p_number, p_bank = None, None, None
+    else:
+        balance, p_method, p_number, p_bank = user_data[:4]
+
+    rub_balance = int(balance * main.XTR_TO_RUB_RATE)
+    text = f"ваш баланс: {balance} <tg-emoji emoji-id=\"5384159397263990339\">⭐</tg-emoji> • {rub_balance} ₽\n"
+    kb = InlineKeyboardBuilder()
+    if not p_number:
+        text += f"для вывода средств добавьте <tg-emoji emoji-id=\"{main.EMOJI_BANK_REQ}\">🏦</tg-emoji> введите сбп или <tg-emoji emoji-id=\"{main.EMOJI_CARD}\">🏦</tg-emoji> карту"
+        kb.row(InlineKeyboardButton(text="добавить реквизиты", callback_data="add_payment_details"))
+    else:
+        text += "ваши реквизиты:\n<blockquote>"
+        if p_method == 'sbp':
+            text += f"<tg-emoji emoji-id=\"{main.EMOJI_BANK_REQ}\">🏦</tg-emoji> сбп • {p_number} • {p_bank}"
+        else:
+            text += f"<tg-emoji emoji-id=\"{main.EMOJI_CARD}\">🏦</tg-emoji> карта • {p_number}"
+        text += "</blockquote>"
+        kb.row(InlineKeyboardButton(text="✏️ изменить реквизиты", callback_data="add_payment_details"))
+        kb.row(InlineKeyboardButton(text="💎 вывести", callback_data="withdraw_funds"))
+    kb.row(InlineKeyboardButton(text="назад", callback_data="back_to_menu"))
+    await message.edit_text(text, parse_mode="HTML", reply_markup=kb.as_markup())
+
+
+async def render_cost(message: FakeMessage, renders: int, render) -> tuple:
+    """Микросекунды, выделения памяти и пиковая память сверх уже занятой на одну отрисовку (tracemalloc).
+
+    Выделения - прирост числа живых блоков между снимками до и после серии отрисовок, пока их результат
+    ещё держится в FakeMessage; временные объекты, освобождённые по ходу отрисовки, видны только в пике.
+    """
+    started = time.perf_counter()
+    for i in range(renders):
+        await render(i)
+    micros = (time.perf_counter() - started) / renders * 1e6
+    message.edits.clear()
+
+    sample = min(renders, 1000)
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for i in range(sample):
+        await render(i)
+    after = tracemalloc.take_snapshot()
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, "filename"))
+    message.edits.clear()
+
+    peaks = []
+    for i in range(sample):
+        current = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        await render(i)
+        peaks.append(tracemalloc.get_traced_memory()[1] - current)
+    tracemalloc.stop()
+    message.edits.clear()
+    return micros, blocks / sample, sum(peaks) / len(peaks)
+
+
+async def bench_ui(args):
+    main = load_main(os.path.join(tempfile.mkdtemp(), "ui.db"))
+    # Профили из кэша: сравнивается только сборка текста и клавиатуры
+    profiles = [(0, None, None, None), (1500, "sbp", "+79990000000", "тинькофф"), (700, "card", "2200000000000000", None)]
+    for user_id in range(args.users):
+        main.user_cache.cache.set(user_id, profiles[user_id % len(profiles)])
+    message = FakeMessage()
+    print(f"ui: {args.renders} отрисовок, профили пустые / сбп / карта вперемешку")
+
+    async def old_menu(i):
+        await message.edit_text("главное меню:", reply_markup=await legacy_main_menu_kb(i))
+
+    async def new_menu(i):
+        await message.edit_text("главное меню:", reply_markup=main.MAIN_MENU_KB)
+
+    for title, before, after in (
+        ("show_profile", lambda i: legacy_show_profile(main, message, i % args.users), lambda i: main.show_profile(message, i % args.users)),
+        ("главное меню", old_menu, new_menu),
+    ):
+        before_us, before_blocks, before_peak = await render_cost(message, args.renders, before)
+        after_us, after_blocks, after_peak = await render_cost(message, args.renders, after)
+        print(f"  {title:<32} {before_us:>8.1f} -> {after_us:>6.1f} мкс  (x{before_us / after_us:.1f}), "
+              f"блоков {before_blocks:.0f} -> {after_blocks:.0f}, пик памяти {before_peak:.0f} -> {after_peak:.0f} байт")
+
+
+# ------------------- startup: миграции на большой старой базе (было: ALTER в try/except на каждом старте) -------------------
+def build_legacy_db(path: str, users: int):
+    """Схема до миграций: users без новых колонок, withdrawals без индексов, used_links с TEXT-ключом."""
+    db = sqlite3.connect(path)
+    db.executescript("""
+        PRAGMA journal_mode=WAL;
+        CREATE TABLE users (user_id INTEGER PRIMARY KEY, balance INTEGER DEFAULT 0,
+            payment_method TEXT, payment_number TEXT, payment_bank TEXT);
+        CREATE TABLE withdrawals (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, amount INTEGER,
+            rub_amount INTEGER, details TEXT, user_message_id INTEGER, status TEXT DEFAULT 'wait');
+        CREATE TABLE used_links (link_uuid TEXT PRIMARY KEY);
+    """)
+    chunk = 100000
+    for start in range(0, users, chunk):
+        rows = range(start, min(start + chunk, users))
+        db.executemany("INSERT INTO users (user_id, balance) VALUES (?, ?)", ((uid, uid % 5000) for uid in rows))
+        # Две заявки на пользователя; почти все закрыты, новых около процента, на рассмотрении - доли процента
+        db.executemany(
+            "INSERT INTO withdrawals (user_id, amount, rub_amount, details, status) VALUES (?, ?, ?, ?, ?)",
+            ((random.randrange(users), 1000, 1400, "карта • 2200000000000000",
+              random.choices(("wait", "review", "done"), (100, 1, 9899))[0]) for _ in range(2 * len(rows)))
+        )
+        db.executemany("INSERT INTO used_links (link_uuid) VALUES (?)", ((uuid.uuid4().hex[:12],) for _ in rows))
+        db.commit()
+    db.close()
+
+
+async def legacy_init_db(path: str):
+    async with aiosqlite.connect(path) as db:
+        await db.execute("CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, balance INTEGER DEFAULT 0)")
+        for col_name, col_type in (("payment_method", "TEXT"), ("payment_number", "TEXT"), ("payment_bank", "TEXT")):
+            try:
+                await db.execute(f"ALTER TABLE users ADD COLUMN {col_name} {col_type}")
+            except Exception:
+                pass
+        await db.execute(
+            "CREATE TABLE IF NOT EXISTS withdrawals (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, amount INTEGER, "
+            "rub_amount INTEGER, details TEXT, user_message_id INTEGER, status TEXT DEFAULT 'wait')"
+        )
+        await db.execute("CREATE TABLE IF NOT EXISTS used_links (link_uuid TEXT PRIMARY KEY)")
+        await db.commit()
+
+
+async def bench_startup(args):
+    path = os.path.join(tempfile.mkdtemp(), "startup.db")
+    started = time.perf_counter()
+    build_legacy_db(path, args.users)
+    print(f"startup: старая база, {args.users} пользователей, {2 * args.users} заявок, {args.users} used_links "
+          f"(собрана за {time.perf_counter() - started:.1f} с, {os.path.getsize(path) / 2 ** 20:.0f} МБ)")
+
+    started = time.perf_counter()
+    await legacy_init_db(path)
+    print(f"  {'старый init_db':<32} {(time.perf_counter() - started) * 1000:>10.1f} мс")
+
+    # Те же запросы истории и очереди админа, что в main.py, до и после индексов withdrawals
+    sample = [random.randrange(args.users) for _ in range(args.queries)]
+    history_sql = "SELECT id, amount, rub_amount, status FROM withdrawals WHERE user_id = ? AND id < ? ORDER BY id DESC LIMIT 10"
+    queue_sql = "SELECT id, user_id, amount, rub_amount, details FROM withdrawals WHERE status = ? AND id > ? ORDER BY id LIMIT 10"
+
+    queries = {
+        "страница истории": lambda uid: (history_sql, (uid, 2 ** 63 - 1)),
+        "очередь wait (~1%)": lambda uid: (queue_sql, ("wait", uid * 2)),
+        "очередь review (~0.01%)": lambda uid: (queue_sql, ("review", uid * 2)),
+    }
+
+    async def query_ms(db) -> dict:
+        timings = {}
+        for title, query in queries.items():
+            started = time.perf_counter()
+            for uid in sample:
+                async with db.execute(*query(uid)) as cursor:
+                    await cursor.fetchall()
+            timings[title] = (time.perf_counter() - started) / len(sample) * 1000
+        return timings
+
+    async with aiosqlite.connect(path) as db:
+        before = await query_ms(db)
+
+    main = load_main(path)
+    started = time.perf_counter()
+    await main.init_db()
+    first = time.perf_counter() - started
+    print(f"  {'первый старт: все миграции':<32} {first * 1000:>10.1f} мс")
+    for attempt in range(3):
+        await main.db_pool.close()
+        started = time.perf_counter()
+        await main.init_db()
+        print(f"  {f'повторный старт {attempt + 1}':<32} {(time.perf_counter() - started) * 1000:>10.1f} мс  (с открытием пула)")
+
+    async with main.db_pool.read() as db:
+        after = await query_ms(db)
+    await main.db_pool.close()
+    for title in queries:
+        print(f"  {title:<32} {before[title]:>10.3f} -> {after[title]:>7.3f} мс  (x{before[title] / after[title]:.0f})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Микробенчмарки оптимизаций бота: было/стало")
+    modes = parser.add_subparsers(dest="mode", required=True)
+
+    db = modes.add_parser("db", help="пул соединений SQLite против соединения на каждый вызов")
+    db.add_argument("--ops", type=int, default=2000, help="операций в каждом замере")
+    db.add_argument("--users", type=int, default=200, help="сколько разных пользователей")
+    db.add_argument("--concurrency", type=int, default=50, help="одновременных вызовов в параллельных замерах")
+    db.set_defaults(func=bench_db)
+
+    codes = modes.add_parser("codes", help="аллокатор кодов против перебора случайных кодов")
+    codes.add_argument("--ops", type=int, default=100000, help="выдач в каждом замере")
+    codes.add_argument("--occupancy", type=float, nargs="+", default=[0.5, 0.9, 0.95, 0.99], help="доли занятых коротких кодов")
+    codes.set_defaults(func=bench_codes)
+
+    inline = modes.add_parser("inline", help="ответы на inline-запросы: шаблоны против сборки с нуля")
+    inline.add_argument("--answers", type=int, default=20000, help="сколько запросов обработать")
+    inline.add_argument("--amounts", type=int, default=500, help="суммы берутся случайно из 1..N")
+    inline.add_argument("--merchants", type=int, default=500, help="продавцов в замере прямых ссылок, по 10 сумм у каждого")
+    inline.set_defaults(func=bench_inline)
+
+    ui = modes.add_parser("ui", help="отрисовка профиля и меню: готовые клавиатуры и шаблоны против сборки на каждый апдейт")
+    ui.add_argument("--renders", type=int, default=20000, help="отрисовок в каждом замере")
+    ui.add_argument("--users", type=int, default=300, help="сколько профилей в кэше")
+    ui.set_defaults(func=bench_ui)
+
+    startup = modes.add_parser("startup", help="первый и повторные старты на большой базе старой схемы")
+    startup.add_argument("--users", type=int, default=1000000, help="пользователей; заявок вдвое больше, used_links столько же")
+    startup.add_argument("--queries", type=int, default=200, help="запросов истории и очереди в замере")
+    startup.set_defaults(func=bench_startup)
+
+    args = parser.parse_args()
+    asyncio.run(args.func(args))
@@ -0,0 +1,487 @@
+"""Нагрузочный прогон бота против локальной заглушки Bot API.
+
+Поднимает фейковый Bot API (aiohttp), запускает Dispatcher бота в режиме
+polling или webhook и гоняет через него тысячи пар продавец/покупатель по
+обоим сценариям оплаты: по коду и по инлайн-ссылке inline_pay_. Печатает
+пропускную способность, перцентили задержек и ожидание писателя БД.
+
+    python loadtest.py --pairs 500 --rounds 2 --transport polling
+    python loadtest.py --pairs 1000 --inline-share 1 --transport webhook
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict, deque
+
+from aiohttp import ClientSession, web
+
+
+def percentile(values, p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def histogram_percentile(histogram, label_values: tuple, p: float) -> str:
+    # Оценка сверху по границам бакетов гистограммы из main.py
+    series = histogram.series.get(label_values)
+    if not series:
+        return "-"
+    counts, _ = series
+    target = sum(counts) * p / 100
+    seen = 0
+    for bound, count in zip(histogram.buckets, counts):
+        seen += count
+        if seen >= target:
+            return f"≤ {bound * 1000:g} мс"
+    return f"> {histogram.buckets[-1] * 1000:g} мс"
+
+
+async def start_site(app: web.Application, port: int = 0):
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", port)
+    await site.start()
+    return runner, runner.addresses[0][1]
+
+
+class FlowError(Exception):
+    pass
+
+
+class Call:
+    """Вызов Bot API, который бот адресовал конкретному чату."""
+
+    def __init__(self, method: str, params: dict, result):
+        self.method = method
+        self.params = params
+        self.result = result
+
+    @property
+    def text(self) -> str:
+        return self.params.get("text", "")
+
+    @property
+    def message_id(self) -> int:
+        if isinstance(self.result, dict):
+            return self.result["message_id"]
+        return int(self.params["message_id"])
+
+    def button(self, row: int = 0, col: int = 0) -> dict:
+        markup = json.loads(self.params["reply_markup"])
+        return markup["inline_keyboard"][row][col]
+
+
+class FakeBotAPI:
+    """Заглушка Bot API: отвечает как Telegram и раскладывает вызовы по чатам."""
+
+    def __init__(self, bot_username: str):
+        self.bot_username = bot_username
+        self.message_ids = itertools.count(1)
+        self.inbox = defaultdict(asyncio.Queue)  # chat_id -> вызовы, адресованные чату
+        self.answers = {}  # id запроса (inline, pre_checkout) -> future с ответом бота
+        self.invoice_links = {}  # url -> вызов createInvoiceLink, по нему покупатель платит без /start
+        self.updates = deque()
+        self.updates_ready = asyncio.Event()
+        self.calls = Counter()
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        return app
+
+    def message(self, chat_id: int, params: dict) -> dict:
+        return {
+            "message_id": next(self.message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "text": params.get("text", ""),
+        }
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = dict(await request.post())
+        self.calls[method] += 1
+        handler = getattr(self, f"api_{method}", None)
+        result = await handler(params) if handler else True
+        return web.json_response({"ok": True, "result": result})
+
+    def deliver(self, chat_id: int, method: str, params: dict, result):
+        self.inbox[chat_id].put_nowait(Call(method, params, result))
+        return result
+
+    def answer(self, query_id: str, value):
+        future = self.answers.pop(query_id, None)
+        if future and not future.done():
+            future.set_result(value)
+        return True
+
+    async def api_getMe(self, params):
+        return {"id": 42, "is_bot": True, "first_name": "loadtest", "username": self.bot_username}
+
+    async def api_getUpdates(self, params):
+        offset = int(params.get("offset", 0))
+        while self.updates and self.updates[0]["update_id"] < offset:
+            self.updates.popleft()
+        if not self.updates:
+            self.updates_ready.clear()
+            try:
+                await asyncio.wait_for(self.updates_ready.wait(), float(params.get("timeout", 0)) or 0.05)
+            except asyncio.TimeoutError:
+                return []
+        return list(itertools.islice(self.updates, int(params.get("limit", 100))))
+
+    async def api_getChat(self, params):
+        chat_id = int(params["chat_id"])
+        return {
+            "id": chat_id, "type": "private", "first_name": f"user{chat_id}",
+            "accent_color_id": 0, "max_reaction_count": 0,
+        }
+
+    async def api_sendMessage(self, params):
+        chat_id = int(params["chat_id"])
+        return self.deliver(chat_id, "sendMessage", params, self.message(chat_id, params))
+
+    async def api_sendInvoice(self, params):
+        chat_id = int(params["chat_id"])
+        return self.deliver(chat_id, "sendInvoice", params, self.message(chat_id, params))
+
+    async def api_editMessageText(self, params):
+        if "inline_message_id" in params:
+            return True
+        chat_id = int(params["chat_id"])
+        return self.deliver(chat_id, "editMessageText", params, self.message(chat_id, params) | {
+            "message_id": int(params["message_id"]),
+        })
+
+    async def api_deleteMessage(self, params):
+        return self.deliver(int(params["chat_id"]), "deleteMessage", params, True)
+
+    async def api_answerInlineQuery(self, params):
+        return self.answer(params["inline_query_id"], json.loads(params["results"]))
+
+    async def api_answerPreCheckoutQuery(self, params):
+        return self.answer(params["pre_checkout_query_id"], params.get("ok") == "true")
+
+    async def api_createInvoiceLink(self, params):
+        url = f"https://t.me/$loadtest{next(self.message_ids)}"
+        self.invoice_links[url] = Call("createInvoiceLink", params, url)
+        return url
+
+
+class Harness:
+    """Доставляет апдейты боту (через getUpdates или webhook) и собирает статистику."""
+
+    def __init__(self, api: FakeBotAPI, transport: str, timeout: float, think: float):
+        self.api = api
+        self.transport = transport
+        self.timeout = timeout
+        self.think = think
+        self.update_ids = itertools.count(1)
+        self.webhook_url = None
+        self.webhook_headers = None
+        self.http = None
+        self.acks = []
+        self.rejected = 0
+        self.sent_updates = 0
+
+    async def send(self, update: dict):
+        update["update_id"] = next(self.update_ids)
+        self.sent_updates += 1
+        if self.transport == "polling":
+            self.api.updates.append(update)
+            self.api.updates_ready.set()
+            return
+        started = time.perf_counter()
+        async with self.http.post(self.webhook_url, json=update, headers=self.webhook_headers) as response:
+            if response.status != 200:
+                self.rejected += 1
+                raise FlowError(f"webhook ответил {response.status}")
+        self.acks.append(time.perf_counter() - started)
+
+
+class SimUser:
+    """Пользователь Telegram: шлёт апдейты и ждёт, что бот ему ответит."""
+
+    def __init__(self, harness: Harness, user_id: int):
+        self.harness = harness
+        self.id = user_id
+
+    @property
+    def user(self) -> dict:
+        return {"id": self.id, "is_bot": False, "first_name": f"user{self.id}"}
+
+    @property
+    def chat(self) -> dict:
+        return {"id": self.id, "type": "private"}
+
+    async def send_text(self, text: str):
+        await self.harness.send({"message": {
+            "message_id": next(self.harness.api.message_ids), "date": int(time.time()),
+            "chat": self.chat, "from": self.user, "text": text,
+        }})
+
+    async def press(self, message_id: int, data: str):
+        await self.harness.send({"callback_query": {
+            "id": str(random.getrandbits(63)), "from": self.user, "chat_instance": str(self.id), "data": data,
+            "message": {"message_id": message_id, "date": int(time.time()), "chat": self.chat, "text": ""},
+        }})
+
+    async def ask(self, kind: str, body: dict):
+        # Inline и pre_checkout отвечают не в чат, а по id запроса
+        query_id = str(random.getrandbits(63))
+        future = asyncio.get_running_loop().create_future()
+        self.harness.api.answers[query_id] = future
+        await self.harness.send({kind: {"id": query_id, "from": self.user, **body}})
+        try:
+            return await asyncio.wait_for(future, self.harness.timeout)
+        except asyncio.TimeoutError:
+            self.harness.api.answers.pop(query_id, None)
+            raise FlowError(f"нет ответа на {kind}")
+
+    async def pay(self, payload: str, amount: int):
+        await self.harness.send({"message": {
+            "message_id": next(self.harness.api.message_ids), "date": int(time.time()),
+            "chat": self.chat, "from": self.user,
+            "successful_payment": {
+                "currency": "XTR", "total_amount": amount, "invoice_payload": payload,
+                "telegram_payment_charge_id": f"charge_{random.getrandbits(63)}",
+                "provider_payment_charge_id": "",
+            },
+        }})
+
+    async def wait(self, method: str, contains: str = "") -> Call:
+        # Лишние вызовы (удаления, правки после оплаты) пропускаем
+        inbox = self.harness.api.inbox[self.id]
+        deadline = time.perf_counter() + self.harness.timeout
+        while True:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                raise FlowError(f"не дождались {method} «{contains}»")
+            try:
+                call = await asyncio.wait_for(inbox.get(), remaining)
+            except asyncio.TimeoutError:
+                continue
+            if call.method == method and contains in call.text:
+                return call
+
+
+class Stats:
+    def __init__(self):
+        self.flows = defaultdict(list)  # сценарий -> длительности
+        self.steps = defaultdict(list)  # шаг -> длительности
+        self.errors = Counter()
+
+    def step(self, name: str, started: float):
+        self.steps[name].append(time.perf_counter() - started)
+
+
+async def open_menu(user: SimUser) -> Call:
+    await user.send_text("/start")
+    return await user.wait("sendMessage", "что хочешь сделать")
+
+
+async def checkout(user: SimUser, invoice: Call, stats: Stats):
+    payload = invoice.params["payload"]
+    amount = json.loads(invoice.params["prices"])[0]["amount"]
+    # Живой покупатель не нажимает «оплатить» в ту же миллисекунду, когда пришёл счёт
+    await asyncio.sleep(user.harness.think)
+
+    started = time.perf_counter()
+    ok = await user.ask("pre_checkout_query", {"currency": "XTR", "total_amount": amount, "invoice_payload": payload})
+    stats.step("pre_checkout", started)
+    if not ok:
+        raise FlowError("pre_checkout отклонён")
+
+    started = time.perf_counter()
+    await user.pay(payload, amount)
+    await user.wait("sendMessage", "оплата прошла успешно")
+    stats.step("successful_payment", started)
+
+
+async def code_flow(merchant: SimUser, payer: SimUser, amount: int, stats: Stats):
+    menu = await open_menu(payer)
+    started = time.perf_counter()
+    await payer.press(menu.message_id, "make_payment")
+    shown = await payer.wait("editMessageText", "твой код")
+    stats.step("выдача кода", started)
+    code = re.search(r"<code>(\d+)</code>", shown.text).group(1)
+
+    merchant_menu = await open_menu(merchant)
+    await merchant.press(merchant_menu.message_id, "receive_payment")
+    await merchant.wait("editMessageText", "код клиента")
+    started = time.perf_counter()
+    await merchant.send_text(f"{code} {amount}")
+    confirm = await merchant.wait("editMessageText", "выставить счёт")
+    stats.step("ввод кода", started)
+
+    started = time.perf_counter()
+    await merchant.press(merchant_menu.message_id, confirm.button()["callback_data"])
+    invoice = await payer.wait("sendInvoice")
+    stats.step("выставление счёта", started)
+    await checkout(payer, invoice, stats)
+
+
+async def inline_flow(merchant: SimUser, payer: SimUser, amount: int, stats: Stats):
+    started = time.perf_counter()
+    results = await merchant.ask("inline_query", {"query": str(amount), "offset": ""})
+    stats.step("inline_query", started)
+    url = results[0]["reply_markup"]["inline_keyboard"][0][0]["url"]
+
+    invoice = merchant.harness.api.invoice_links.get(url)
+    if invoice is None:
+        # Ссылка через /start: бот сам выставит счёт плательщику
+        started = time.perf_counter()
+        await payer.send_text(f"/start {url.split('start=', 1)[1]}")
+        invoice = await payer.wait("sendInvoice")
+        stats.step("инлайн-счёт", started)
+    await checkout(payer, invoice, stats)
+
+
+async def run_pair(index: int, harness: Harness, args, stats: Stats, limit: asyncio.Semaphore):
+    merchant = SimUser(harness, 1_000_000 + index)
+    payer = SimUser(harness, 2_000_000 + index)
+    for _ in range(args.rounds):
+        kind = "inline" if random.random() < args.inline_share else "code"
+        flow = inline_flow if kind == "inline" else code_flow
+        async with limit:
+            started = time.perf_counter()
+            try:
+                await flow(merchant, payer, random.randint(1, 500), stats)
+            except FlowError as e:
+                stats.errors[f"{kind}: {e}"] += 1
+                continue
+            stats.flows[kind].append(time.perf_counter() - started)
+
+
+def print_report(main, harness: Harness, stats: Stats, elapsed: float):
+    ok = sum(len(values) for values in stats.flows.values())
+    failed = sum(stats.errors.values())
+    print(f"сценариев: {ok} успешно, {failed} с ошибкой за {elapsed:.2f} с ({ok / elapsed:.1f} оплат/с)")
+    print(f"апдейтов: {harness.sent_updates} ({harness.sent_updates / elapsed:.0f}/с), транспорт: {harness.transport}")
+    for error, count in stats.errors.most_common(5):
+        print(f"  ошибка: {error} ×{count}")
+
+    def line(title, values):
+        print(f"  {title:<20} p50 {percentile(values, 50) * 1000:7.1f} мс  p95 {percentile(values, 95) * 1000:7.1f} мс"
+              f"  p99 {percentile(values, 99) * 1000:7.1f} мс  (n={len(values)})")
+
+    print("сценарии целиком:")
+    for kind, values in stats.flows.items():
+        line(kind, values)
+    print("шаги:")
+    for name, values in stats.steps.items():
+        line(name, values)
+    if harness.acks:
+        print("webhook:")
+        line("подтверждение", harness.acks)
+        line("обработка апдейта", list(main.update_scheduler.latencies))
+
+    print("БД:")
+    wait = main.db_write_wait_seconds
+    counts, total = wait.series.get((), ([0], 0.0))
+    if sum(counts):
+        print(f"  ожидание писателя: {sum(counts)} транзакций, в среднем {total / sum(counts) * 1000:.2f} мс,"
+              f" p99 {histogram_percentile(wait, (), 99)}")
+    busiest = sorted(main.db_seconds.series.items(), key=lambda item: -item[1][1])[:6]
+    for (op,), (counts, total) in busiest:
+        print(f"  {op:<32} {sum(counts):6d} вызовов, всего {total:.2f} с, p99 {histogram_percentile(main.db_seconds, (op,), 99)}")
+    commits = sum(main.db_seconds.series.get(("BalanceWriter._commit",), ([0], 0))[0])
+    payments = len(stats.steps.get("successful_payment", []))
+    if commits:
+        print(f"  групповой коммит: {commits} транзакций на {payments} оплат и регистрации пользователей")
+
+    print("вызовы Bot API:", ", ".join(f"{method} {count}" for method, count in harness.api.calls.most_common()))
+    print(f"RetryAfter: {main.outbound_scheduler.stats['retry_after']}, склеено правок: {main.outbound_scheduler.stats['coalesced']}")
+
+
+async def run(args):
+    api = FakeBotAPI("loadtest_bot")
+    api_runner, api_port = await start_site(api.app())
+
+    os.environ.setdefault("BOT_TOKEN", "123456:loadtest")
+    os.environ.setdefault("ADMIN_ID", "1")
+    os.environ.setdefault("BOT_USERNAME", "loadtest_bot")
+    os.environ.setdefault("INLINE_DEBOUNCE", "0")
+    os.environ["METRICS_ENABLED"] = "1"
+    os.environ["TELEGRAM_API_URL"] = f"http://127.0.0.1:{api_port}"
+    os.environ["DB_NAME"] = os.path.join(tempfile.mkdtemp(), "loadtest.db")
+    if not args.real_limits:
+        # Иначе мерили бы лимиты Telegram, а не бота
+        os.environ.setdefault("API_GLOBAL_RATE", "1000000")
+        os.environ.setdefault("API_CHAT_RATE", "1000000")
+        for name in ("ANTIFLOOD_RATE", "ANTIFLOOD_CODE_RATE", "ANTIFLOOD_WITHDRAW_RATE", "ANTIFLOOD_BUTTON_RATE"):
+            os.environ.setdefault(name, "1000000/1")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main
+    # Лог на каждый апдейт сам по себе съедает заметную часть времени
+    logging.getLogger("aiogram.event").setLevel(logging.WARNING)
+    logging.getLogger("aiogram.dispatcher").setLevel(logging.WARNING)
+
+    await main.init_db()
+    main.balance_writer.start()
+    await main.state_backend.start()
+    if main.STATE_BACKEND == "memory":
+        main.fsm_storage.start()
+    main.start_background(main.user_names.run())
+
+    harness = Harness(api, args.transport, args.timeout, args.think)
+    bot_runner = polling = None
+    if args.transport == "webhook":
+        bot_runner, bot_port = await start_site(main.create_webhook_app())
+        harness.webhook_url = f"http://127.0.0.1:{bot_port}{main.WEBHOOK_PATH}"
+        harness.webhook_headers = {"X-Telegram-Bot-Api-Secret-Token": main.WEBHOOK_SECRET}
+        harness.http = ClientSession()
+    else:
+        polling = asyncio.create_task(main.dp.start_polling(
+            main.bot, polling_timeout=1, handle_signals=False, close_bot_session=False
+        ))
+
+    stats = Stats()
+    limit = asyncio.Semaphore(args.concurrency or args.pairs)
+    started = time.perf_counter()
+    await asyncio.gather(*(run_pair(i, harness, args, stats, limit) for i in range(args.pairs)))
+    if args.transport == "webhook":
+        await main.update_scheduler.drain()
+    elapsed = time.perf_counter() - started
+
+    print_report(main, harness, stats, elapsed)
+
+    if polling:
+        await main.dp.stop_polling()
+        await polling
+        # Хэндлеры из polling живут отдельными задачами и могут ещё дописывать в БД
+        await asyncio.gather(*main.dp._handle_update_tasks, return_exceptions=True)
+    if bot_runner:
+        await harness.http.close()
+        await bot_runner.cleanup()
+    await main.stop_background()
+    await main.balance_writer.stop()
+    await main.user_names.flush()
+    if main.STATE_BACKEND == "memory":
+        await main.fsm_storage.close()
+    await main.db_pool.close()
+    await main.bot.session.close()
+    await api_runner.cleanup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон бота против заглушки Bot API")
+    parser.add_argument("--pairs", type=int, default=500, help="сколько пар продавец/покупатель")
+    parser.add_argument("--rounds", type=int, default=2, help="сколько оплат проводит каждая пара")
+    parser.add_argument("--inline-share", type=float, default=0.5, help="доля оплат по инлайн-ссылке")
+    parser.add_argument("--concurrency", type=int, default=0, help="одновременных сценариев (0 - все пары сразу)")
+    parser.add_argument("--transport", choices=("polling", "webhook"), default="polling", help="как бот получает апдейты")
+    parser.add_argument("--think", type=float, default=0.5, help="пауза покупателя перед оплатой счёта, сек")
+    parser.add_argument("--timeout", type=float, default=30, help="сколько ждать ответа бота на шаг, сек")
+    parser.add_argument("--real-limits", action="store_true", help="не снимать лимиты исходящих запросов")
+    asyncio.run(run(parser.parse_args()))
@@ -1,19 +1,36 @@
 import asyncio
 import random
-import string
 import re
 import aiosqlite
 import html
 import logging
 import uuid
+import functools
 import os
-from contextlib import suppress
-
-from aiogram import Bot, Dispatcher, F, Router, types
+import json
+import time
+import math
+import hashlib
+import heapq
+import itertools
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager, suppress
+from contextvars import ContextVar
+
+from aiohttp import web
+from aiogram import BaseMiddleware, Bot, Dispatcher, F, Router, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
 from aiogram.filters import Command, CommandObject
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.types import InlineKeyboardButton, LabeledPrice, PreCheckoutQuery, InlineQueryResultArticle, InputTextMessageContent
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+from aiogram.methods import AnswerPreCheckoutQuery, DeleteMessage, EditMessageReplyMarkup, EditMessageText, SendInvoice
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, LabeledPrice, PreCheckoutQuery, InlineQueryResultArticle, InputTextMessageContent
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
 # ------------------- КОНФИГУРАЦИЯ -------------------
@@ -21,10 +38,80 @@ TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_ID = int(os.getenv("ADMIN_ID"))
 BOT_USERNAME = os.getenv("BOT_USERNAME")
 XTR_TO_RUB_RATE = 1.8
-DB_NAME = "bot_database.db"
+DB_NAME = os.getenv("DB_NAME", "bot_database.db")
+DB_READERS = int(os.getenv("DB_READERS", "4"))  # Читающих соединений в пуле
+BALANCE_BATCH_WINDOW = float(os.getenv("BALANCE_BATCH_WINDOW", "0.002"))  # Окно группового коммита, сек
+PENDING_INVOICE_TTL = int(os.getenv("PENDING_INVOICE_TTL", str(24 * 3600)))  # Сколько живёт неоплаченный счёт, сек
+INVOICE_CACHE_SIZE = 10000  # Сколько счетов держим в памяти
+PENDING_INVOICE_FLUSH_INTERVAL = 1.0  # Как часто изменения счетов пачкой пишутся в БД, сек
+PROCESSED_CHARGES_CACHE = 50000  # Сколько недавних charge_id помним в памяти, чтобы повторы не ходили в БД
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "50000"))  # Сколько профилей пользователей держим в памяти
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", "300"))  # Сколько живёт запись профиля в кэше, сек
+USER_NAME_CACHE_SIZE = int(os.getenv("USER_NAME_CACHE_SIZE", "100000"))  # Сколько имён пользователей держим в памяти
+USER_NAME_TTL = int(os.getenv("USER_NAME_TTL", str(24 * 3600)))  # Через сколько сохранённое имя считается устаревшим, сек
+USER_NAME_FLUSH_INTERVAL = 5.0  # Как часто новые имена пачкой пишутся в БД, сек
+USED_LINKS_BLOOM_CAPACITY = int(os.getenv("USED_LINKS_BLOOM_CAPACITY", "1000000"))  # На сколько ссылок рассчитан Bloom-фильтр
+USED_LINKS_RETENTION_DAYS = int(os.getenv("USED_LINKS_RETENTION_DAYS", "0"))  # 0 - хранить использованные ссылки вечно
 CONFETTI_EFFECT_ID = "5046509860389126442"
 CODE_LENGTH = 4
+LONG_CODE_LENGTH = 6  # Длина кодов, когда короткие почти закончились
+LONG_CODE_THRESHOLD = float(os.getenv("LONG_CODE_THRESHOLD", "0.9"))  # Доля занятых коротких кодов для перехода на длинные
+CODE_TTL = int(os.getenv("CODE_TTL", "900"))  # Сколько живёт неиспользованный код, сек
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory")  # memory - один процесс, redis - несколько воркеров
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", "100000"))  # Сколько FSM-состояний держим в памяти
+FSM_CACHE_TTL = 600  # Через сколько секунд без записи состояние выгружается из памяти
+FSM_FLUSH_INTERVAL = 1.0  # Как часто изменения FSM пачкой пишутся в БД, сек
+FSM_STATE_TTL_DAYS = int(os.getenv("FSM_STATE_TTL_DAYS", "30"))  # Брошенные диалоги старше этого удаляются из БД
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")  # Свой Bot API сервер, например локальный
+
+# Лимиты исходящих запросов к Telegram - на процесс, а не на весь бот
+API_GLOBAL_RATE = float(os.getenv("API_GLOBAL_RATE", "30"))  # Запросов в секунду на процесс; при N воркерах делите на N
+API_CHAT_RATE = float(os.getenv("API_CHAT_RATE", "1"))  # Новых сообщений в секунду в один личный чат
+API_GROUP_RATE = float(os.getenv("API_GROUP_RATE", str(20 / 60)))  # Новых сообщений в секунду в одну группу
+API_CHAT_BURST = 3  # Сколько сообщений подряд можно отправить в чат без ожидания
+API_MAX_RETRIES = 3  # Повторов после RetryAfter
+
+# Инлайн-режим
+INLINE_DEBOUNCE = float(os.getenv("INLINE_DEBOUNCE", "0.3"))  # Ждём, пока пользователь допечатает сумму, сек
+INLINE_DIRECT_LINKS = os.getenv("INLINE_DIRECT_LINKS", "1") == "1"  # Кнопка в инлайн-сообщении сразу открывает оплату, без /start
+INVOICE_LINK_POOL = int(os.getenv("INVOICE_LINK_POOL", "3"))  # Сколько готовых ссылок держим на пару продавец-сумма
+INVOICE_LINK_TTL_DAYS = int(os.getenv("INVOICE_LINK_TTL_DAYS", "30"))  # Сколько живёт неоплаченная ссылка на оплату, дней
+INVOICE_LINK_FLUSH_INTERVAL = 1.0  # Как часто выданные из памяти ссылки пачкой отмечаются в БД, сек
+INVOICE_RESERVE_TTL = 60  # Сколько после pre_checkout ссылка закреплена за плательщиком, сек
+
+# Антифлуд входящих: "N/S" - не больше N событий за S секунд
+ANTIFLOOD_RATE = os.getenv("ANTIFLOOD_RATE", "20/10")  # Любые сообщения и нажатия одного пользователя
+ANTIFLOOD_CODE_RATE = os.getenv("ANTIFLOOD_CODE_RATE", "5/60")  # Неудачные попытки ввести код клиента (перебор)
+ANTIFLOOD_WITHDRAW_RATE = os.getenv("ANTIFLOOD_WITHDRAW_RATE", "3/60")  # Нажатия «вывести»
+ANTIFLOOD_BUTTON_RATE = os.getenv("ANTIFLOOD_BUTTON_RATE", "10/60")  # Кнопки, которые ходят в БД: профиль, новый код, история
+
+# Режим получения апдейтов: polling или webhook
+RUN_MODE = os.getenv("RUN_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # Публичный адрес, например https://example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_CONCURRENCY = int(os.getenv("WEBHOOK_CONCURRENCY", "64"))  # Сколько апдейтов обрабатываем одновременно
+WEBHOOK_MAX_PENDING = int(os.getenv("WEBHOOK_MAX_PENDING", "2000"))  # Больше - отвечаем 503, Telegram повторит позже
 MIN_WITHDRAWAL_RUB = 10  # Минимальная сумма вывода в рублях
+ADMIN_QUEUE_PAGE = 10  # Заявок на одной странице очереди
+HISTORY_PAGE = 10  # Выводов на одной странице истории пользователя
+NOTIFY_RATE = float(os.getenv("NOTIFY_RATE", "10"))  # Уведомлений пользователям в секунду при массовой смене статуса
+OUTBOX_POLL = 5  # Как часто outbox проверяет отложенные повторы, сек
+OUTBOX_BATCH = 50  # Сколько сообщений outbox забираем за раз
+OUTBOX_LEASE = 60  # На сколько забранное сообщение скрыто от других воркеров, сек
+OUTBOX_MAX_ATTEMPTS = 10  # После стольких неудач сообщение отбрасывается
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "8"))  # Одновременных отправок при рассылке
+BROADCAST_PAGE = 200  # Получателей между сохранениями прогресса рассылки
+BROADCAST_REPORT_INTERVAL = 5  # Как часто обновляем у админа статус рассылки, сек
+BROADCAST_LEASE = 120  # Рассылка без отметки дольше этого считается брошенной (несколько воркеров), сек
+
+# Метрики в формате Prometheus
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"  # 0 - обёртки и middleware вообще не ставятся
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")  # /metrics отдаём только локально
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9090"))
 
 # Эмодзи
 EMOJI_BANK_REQ = "5192678313415434135"  # 🏦 для требования реквизитов
@@ -36,124 +123,1723 @@ EMOJI_CARD = "5192803468762441581"      # Новый премиум эмодзи
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-bot = Bot(token=TOKEN)
-dp = Dispatcher()
+if TELEGRAM_API_URL:
+    bot = Bot(token=TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)))
+else:
+    bot = Bot(token=TOKEN)
+
+# Общее состояние между воркерами (коды, счета, FSM) живёт в Redis
+if STATE_BACKEND == "redis":
+    from redis.asyncio import Redis
+    from aiogram.fsm.storage.redis import RedisStorage
+    redis_client = Redis.from_url(REDIS_URL, decode_responses=True)
+else:
+    redis_client = None
 router = Router()
-dp.include_router(router)
+
+# ------------------- МЕТРИКИ -------------------
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+metrics_registry = []
+metrics_collectors = []  # Функции, которые в момент выгрузки отдают строки с текущими значениями (gauge)
+
+def format_labels(names, values) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(
+        f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+        for name, value in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+def gauge_lines(name: str, help_text: str, value, kind: str = "gauge"):
+    return [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}", f"{name} {value}"]
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.values = {}
+        metrics_registry.append(self)
+
+    def inc(self, *label_values, value=1):
+        self.values[label_values] = self.values.get(label_values, 0) + value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for label_values, value in self.values.items():
+            yield f"{self.name}{format_labels(self.labels, label_values)} {value}"
+
+class Histogram:
+    """Фиксированные бакеты: observe - это bisect и два сложения, без блокировок (один event loop)."""
+
+    def __init__(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}  # значения меток -> [счётчики по бакетам (+Inf последним), сумма]
+        metrics_registry.append(self)
+
+    def observe(self, value: float, *label_values):
+        series = self.series.get(label_values)
+        if series is None:
+            series = self.series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        bucket_labels = self.labels + ("le",)
+        for label_values, (counts, total) in self.series.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                yield f"{self.name}_bucket{format_labels(bucket_labels, label_values + (bound,))} {cumulative}"
+            labels = format_labels(self.labels, label_values)
+            yield f"{self.name}_sum{labels} {total}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+def render_metrics() -> str:
+    lines = []
+    for metric in metrics_registry:
+        lines.extend(metric.render())
+    for collect in metrics_collectors:
+        try:
+            lines.extend(collect())
+        except Exception as e:
+            logger.error(f"Ошибка сбора метрик: {e}")
+    return "\n".join(lines) + "\n"
+
+handler_seconds = Histogram("platilka_handler_seconds", "Время обработки апдейта хэндлером", ("event", "handler"))
+handler_errors = Counter("platilka_handler_errors_total", "Исключения в хэндлерах", ("event", "handler"))
+db_seconds = Histogram("platilka_db_seconds", "Время вызова функций работы с БД", ("op",))
+db_write_wait_seconds = Histogram("platilka_db_write_wait_seconds", "Ожидание соединения-писателя")
+api_seconds = Histogram("platilka_telegram_api_seconds", "Время запроса к Bot API", ("method",))
+api_errors = Counter("platilka_telegram_api_errors_total", "Ошибки запросов к Bot API", ("method", "kind"))
+
+def db_timed(func):
+    # При выключенных метриках функция возвращается как есть - никакой цены на горячем пути
+    if not METRICS_ENABLED:
+        return func
+    op = func.__qualname__
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            db_seconds.observe(time.perf_counter() - started, op)
+    return wrapper
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Inner middleware роутера: вызывается только когда хэндлер уже выбран, поэтому знает его имя."""
+
+    async def __call__(self, handler, event, data):
+        labels = (type(event).__name__, data["handler"].callback.__name__)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            handler_errors.inc(*labels)
+            raise
+        finally:
+            handler_seconds.observe(time.perf_counter() - started, *labels)
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    """Стоит внутри планировщика исходящих: меряет каждую попытку, включая повторы после 429."""
+
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter:
+            api_errors.inc(name, "retry_after")
+            raise
+        except Exception:
+            api_errors.inc(name, "error")
+            raise
+        finally:
+            api_seconds.observe(time.perf_counter() - started, name)
+
+if METRICS_ENABLED:
+    for observer in (router.message, router.callback_query, router.inline_query, router.pre_checkout_query):
+        observer.middleware(HandlerMetricsMiddleware())
 
 # ------------------- БАЗА ДАННЫХ -------------------
-async def init_db():
-    async with aiosqlite.connect(DB_NAME) as db:
-        # Создаем базовую таблицу, если её нет
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                balance INTEGER DEFAULT 0
-            )
-        """)
-        
-        # Миграция: пытаемся добавить новые колонки, если их нет (для старой БД)
-        columns_to_add = [
-            ("payment_method", "TEXT"),
-            ("payment_number", "TEXT"),
-            ("payment_bank", "TEXT")
-        ]
-        
-        for col_name, col_type in columns_to_add:
+class DBPool:
+    """Долгоживущие соединения: один писатель и несколько читателей (WAL)."""
+
+    def __init__(self, path: str, readers: int = 4):
+        self.path = path
+        self.readers_count = readers
+        self.writer = None
+        self.write_lock = asyncio.Lock()
+        self.readers = asyncio.Queue()
+        self._all = []
+
+    async def _connect(self, read_only=False):
+        # cached_statements: sqlite3 переиспользует подготовленные запросы на живом соединении
+        conn = await aiosqlite.connect(self.path, cached_statements=256)
+        await conn.execute("PRAGMA journal_mode=WAL")
+        # Писатель подтверждает коммит только после fsync; читателям это не нужно
+        await conn.execute(f"PRAGMA synchronous={'NORMAL' if read_only else 'FULL'}")
+        await conn.execute("PRAGMA busy_timeout=5000")
+        await conn.execute("PRAGMA temp_store=MEMORY")
+        await conn.execute("PRAGMA cache_size=-16000")
+        if read_only:
+            await conn.execute("PRAGMA query_only=1")
+        self._all.append(conn)
+        return conn
+
+    async def open(self):
+        if self.writer is not None:
+            return
+        self.writer = await self._connect()
+        for _ in range(self.readers_count):
+            self.readers.put_nowait(await self._connect(read_only=True))
+
+    async def close(self):
+        for conn in self._all:
+            with suppress(Exception):
+                await conn.close()
+        self._all.clear()
+        self.writer = None
+        self.readers = asyncio.Queue()
+
+    @asynccontextmanager
+    async def read(self):
+        conn = await self.readers.get()
+        try:
+            yield conn
+        finally:
+            self.readers.put_nowait(conn)
+
+    @asynccontextmanager
+    async def write(self):
+        # Все записи идут через одно соединение: SQLite всё равно допускает одного писателя
+        started = time.perf_counter()
+        async with self.write_lock:
+            if METRICS_ENABLED:
+                db_write_wait_seconds.observe(time.perf_counter() - started)
+            await self.writer.execute("BEGIN IMMEDIATE")
             try:
-                await db.execute(f"ALTER TABLE users ADD COLUMN {col_name} {col_type}")
-            except Exception:
-                # Колонка уже существует, игнорируем ошибку
-                pass
+                yield self.writer
+            except BaseException:
+                await self.writer.rollback()
+                raise
+            else:
+                await self.writer.commit()
+
+db_pool = DBPool(DB_NAME, DB_READERS)
+
+# Миграции схемы: каждая выполняется один раз, номер записывается в schema_version.
+# Шаги идемпотентны, потому что старые базы приходят без schema_version.
+async def table_columns(db, table: str) -> set:
+    async with db.execute(f"PRAGMA table_info({table})") as cursor:
+        return {row[1] for row in await cursor.fetchall()}
+
+async def migrate_base_tables(db):
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            balance INTEGER DEFAULT 0
+        )
+    """)
+    # Старые базы могли появиться до колонок с реквизитами
+    existing = await table_columns(db, "users")
+    for col_name, col_type in (("payment_method", "TEXT"), ("payment_number", "TEXT"), ("payment_bank", "TEXT")):
+        if col_name not in existing:
+            await db.execute(f"ALTER TABLE users ADD COLUMN {col_name} {col_type}")
+
+    # Таблица выводов
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS withdrawals (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            amount INTEGER,
+            rub_amount INTEGER,
+            details TEXT,
+            user_message_id INTEGER,
+            status TEXT DEFAULT 'wait'
+        )
+    """)
+    # Таблица использованных ссылок: ключ в бинарном виде, без rowid - данные лежат прямо в индексе
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS used_links (
+            link_id BLOB PRIMARY KEY,
+            used_day INTEGER NOT NULL
+        ) WITHOUT ROWID
+    """)
+    # Выставленные, но ещё не оплаченные счета (переживают рестарт)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS pending_invoices (
+            payload TEXT PRIMARY KEY,
+            merchant_id INTEGER NOT NULL,
+            merchant_msg_id INTEGER,
+            payer_id INTEGER,
+            payer_prompt_msg_id INTEGER,
+            invoice_msg_id INTEGER,
+            link_uuid TEXT,
+            original_chat_id INTEGER,
+            original_msg_id INTEGER,
+            created_at INTEGER NOT NULL
+        )
+    """)
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_pending_invoices_created ON pending_invoices(created_at)")
 
-        # Таблица выводов
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS withdrawals (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                amount INTEGER,
-                rub_amount INTEGER,
-                details TEXT,
-                user_message_id INTEGER,
-                status TEXT DEFAULT 'wait'
-            )
+async def migrate_compact_used_links(db):
+    # Старый формат: link_uuid TEXT PRIMARY KEY
+    if "link_uuid" not in await table_columns(db, "used_links"):
+        return
+    await db.execute("ALTER TABLE used_links RENAME TO used_links_old")
+    await db.execute("""
+        CREATE TABLE used_links (
+            link_id BLOB PRIMARY KEY,
+            used_day INTEGER NOT NULL
+        ) WITHOUT ROWID
+    """)
+    await db.create_function("link_key", 1, link_key, deterministic=True)
+    await db.execute(
+        "INSERT OR IGNORE INTO used_links (link_id, used_day) SELECT link_key(link_uuid), ? FROM used_links_old",
+        (current_day(),)
+    )
+    await db.execute("DROP TABLE used_links_old")
+
+async def migrate_withdrawal_indexes(db):
+    # Очередь заявок для админа листается по (status, id), история пользователя - по (user_id, id)
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_withdrawals_status_id ON withdrawals(status, id)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_withdrawals_user_id ON withdrawals(user_id, id)")
+
+async def migrate_sales_tables(db):
+    # Сырые продажи плюс агрегаты по продавцу, которые обновляются в той же транзакции, что и начисление
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS payments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            merchant_id INTEGER NOT NULL,
+            payer_id INTEGER,
+            amount INTEGER NOT NULL,
+            charge_id TEXT,
+            payload TEXT,
+            created_at INTEGER NOT NULL
+        )
+    """)
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_payments_merchant ON payments(merchant_id, id)")
+    for table, bucket in (("merchant_sales_hourly", "hour"), ("merchant_sales_daily", "day")):
+        await db.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                merchant_id INTEGER NOT NULL,
+                {bucket} INTEGER NOT NULL,
+                sales INTEGER NOT NULL DEFAULT 0,
+                stars INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (merchant_id, {bucket})
+            ) WITHOUT ROWID
         """)
-        # Таблица использованных ссылок
+
+async def migrate_processed_payments(db):
+    # Ключ идемпотентности: повторно доставленный successful_payment не начисляет второй раз
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS processed_payments (
+            charge_id TEXT PRIMARY KEY,
+            processed_at INTEGER NOT NULL
+        ) WITHOUT ROWID
+    """)
+    # Платежи, проведённые до появления таблицы, тоже считаются обработанными
+    await db.execute("""
+        INSERT OR IGNORE INTO processed_payments (charge_id, processed_at)
+        SELECT charge_id, created_at FROM payments WHERE charge_id IS NOT NULL
+    """)
+
+async def migrate_outbox(db):
+    # Уведомления, которые должны уйти после коммита: пишутся в той же транзакции, что и изменение
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at INTEGER NOT NULL,
+            created_at INTEGER NOT NULL
+        )
+    """)
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_outbox_next_attempt ON outbox(next_attempt_at, id)")
+
+async def migrate_fsm_states(db):
+    # Ключ - StorageKey одной строкой, см. SQLiteStorage
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS fsm_states (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT NOT NULL,
+            updated_at INTEGER NOT NULL
+        ) WITHOUT ROWID
+    """)
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_fsm_states_updated ON fsm_states(updated_at)")
+
+async def migrate_broadcasts(db):
+    # Заблокировавших бота пропускаем в следующих рассылках, пока они снова не напишут /start
+    if "blocked" not in await table_columns(db, "users"):
+        await db.execute("ALTER TABLE users ADD COLUMN blocked INTEGER NOT NULL DEFAULT 0")
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            source_chat_id INTEGER NOT NULL,
+            source_message_id INTEGER NOT NULL,
+            status_message_id INTEGER,
+            status TEXT NOT NULL DEFAULT 'running',
+            last_user_id INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            heartbeat_at INTEGER NOT NULL DEFAULT 0,
+            created_at INTEGER NOT NULL
+        )
+    """)
+
+async def migrate_invoice_links(db):
+    # Готовые ссылки createInvoiceLink: issued_at пустой, пока ссылка лежит в пуле
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS invoice_links (
+            payload TEXT PRIMARY KEY,
+            merchant_id INTEGER NOT NULL,
+            amount INTEGER NOT NULL,
+            url TEXT NOT NULL,
+            created_at INTEGER NOT NULL,
+            issued_at INTEGER
+        ) WITHOUT ROWID
+    """)
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_invoice_links_pool ON invoice_links(merchant_id, amount) WHERE issued_at IS NULL"
+    )
+
+async def migrate_user_names(db):
+    # Имя из последнего апдейта пользователя: экран подтверждения счёта не спрашивает его у Telegram
+    existing = await table_columns(db, "users")
+    for col_name, col_type in (("first_name", "TEXT"), ("name_updated_at", "INTEGER")):
+        if col_name not in existing:
+            await db.execute(f"ALTER TABLE users ADD COLUMN {col_name} {col_type}")
+
+MIGRATIONS = [
+    (1, "базовые таблицы", migrate_base_tables),
+    (2, "компактные used_links", migrate_compact_used_links),
+    (3, "индексы withdrawals", migrate_withdrawal_indexes),
+    (4, "продажи и агрегаты", migrate_sales_tables),
+    (5, "идемпотентность платежей", migrate_processed_payments),
+    (6, "outbox уведомлений", migrate_outbox),
+    (7, "FSM в SQLite", migrate_fsm_states),
+    (8, "рассылки", migrate_broadcasts),
+    (9, "пул ссылок на оплату", migrate_invoice_links),
+    (10, "имена пользователей", migrate_user_names),
+]
+
+async def run_migrations():
+    async with db_pool.write() as db:
         await db.execute("""
-            CREATE TABLE IF NOT EXISTS used_links (
-                link_uuid TEXT PRIMARY KEY
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                name TEXT,
+                applied_at INTEGER
             )
         """)
-        await db.commit()
+        async with db.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version") as cursor:
+            (current,) = await cursor.fetchone()
+    for version, name, step in MIGRATIONS:
+        if version <= current:
+            continue
+        # Каждая миграция - отдельная транзакция вместе с записью о ней
+        async with db_pool.write() as db:
+            await step(db)
+            await db.execute(
+                "INSERT INTO schema_version (version, name, applied_at) VALUES (?, ?, ?)",
+                (version, name, int(time.time()))
+            )
+        logger.info(f"Миграция {version} ({name}) применена")
+
+async def init_db():
+    await db_pool.open()
+    await run_migrations()
+    if USED_LINKS_RETENTION_DAYS:
+        # Индекс нужен только для чистки по дате, поэтому зависит от настройки, а не от версии схемы
+        async with db_pool.write() as db:
+            await db.execute("CREATE INDEX IF NOT EXISTS idx_used_links_day ON used_links(used_day)")
 
 async def get_user_data(user_id: int):
-    async with aiosqlite.connect(DB_NAME) as db:
+    return await user_cache.get(user_id, load_user_data)
+
+@db_timed
+async def load_user_data(user_id: int):
+    async with db_pool.read() as db:
         # Выбираем все поля. Если запись есть, но поля NULL - это ок.
         async with db.execute("SELECT balance, payment_method, payment_number, payment_bank FROM users WHERE user_id = ?", (user_id,)) as cursor:
             return await cursor.fetchone()
 
-async def add_balance(user_id: int, amount: int):
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute("INSERT OR IGNORE INTO users (user_id, balance) VALUES (?, 0)", (user_id,))
-        await db.execute("UPDATE users SET balance = balance + ? WHERE user_id = ?", (amount, user_id))
-        await db.commit()
+class BalanceWriter:
+    """Групповой коммит: начисления и регистрации, пришедшие за короткое окно, пишутся одной транзакцией."""
+
+    def __init__(self, window: float = 0.002, max_batch: int = 1000):
+        self.window = window
+        self.max_batch = max_batch
+        self.queue = asyncio.Queue()
+        self.task = None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
 
+    async def stop(self):
+        if self.task is None:
+            return
+        # Дожидаемся коммита всего, что успели поставить в очередь, и только потом гасим задачу
+        await self.queue.join()
+        self.task.cancel()
+        with suppress(asyncio.CancelledError):
+            await self.task
+        self.task = None
+
+    async def submit(self, user_id: int, amount: int, sale: tuple = None) -> bool:
+        # sale = (payer_id, charge_id, payload, created_at) - продажа, которая пишется вместе с начислением
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((user_id, amount, sale, future))
+        # Ответ вызывающему приходит только после коммита
+        return await future
+
+    def _drain(self, batch):
+        while len(batch) < self.max_batch and not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = [await self.queue.get()]
+            if self.window:
+                await asyncio.sleep(self.window)
+            batch = self._drain(batch)
+            try:
+                await self._commit(batch)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    @db_timed
+    async def _commit(self, batch):
+        try:
+            async with db_pool.write() as db:
+                fresh = await self._claim_charges(db, batch)
+                totals = {}
+                sales = []
+                hourly = {}
+                daily = {}
+                for user_id, amount, sale, _ in batch:
+                    if sale is not None and id(sale) not in fresh:
+                        continue
+                    totals[user_id] = totals.get(user_id, 0) + amount
+                    if sale is None:
+                        continue
+                    payer_id, charge_id, payload, created_at = sale
+                    sales.append((user_id, payer_id, amount, charge_id, payload, created_at))
+                    # Агрегаты сворачиваем в памяти: одна строка на (продавец, бакет) на весь батч
+                    for buckets, key in ((hourly, (user_id, created_at // 3600)), (daily, (user_id, created_at // 86400))):
+                        count, stars = buckets.get(key, (0, 0))
+                        buckets[key] = (count + 1, stars + amount)
+
+                await db.executemany("INSERT OR IGNORE INTO users (user_id, balance) VALUES (?, 0)", [(uid,) for uid in totals])
+                # Регистрация (/start) значит, что пользователь снова с ботом - возвращаем его в рассылки
+                await db.executemany(
+                    "UPDATE users SET blocked = 0 WHERE user_id = ? AND blocked = 1",
+                    [(user_id,) for user_id, amount, sale, _ in batch if not amount and sale is None]
+                )
+                await db.executemany(
+                    "UPDATE users SET balance = balance + ? WHERE user_id = ?",
+                    [(amount, uid) for uid, amount in totals.items() if amount]
+                )
+                if sales:
+                    await db.executemany(
+                        "INSERT INTO payments (merchant_id, payer_id, amount, charge_id, payload, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                        sales
+                    )
+                    # Оплаченная ссылка из пула гаснет в той же транзакции: без зачисления её строка - единственная связь с продавцом
+                    await db.executemany(
+                        "DELETE FROM invoice_links WHERE payload = ?",
+                        [(sale[4],) for sale in sales if sale[4].startswith("direct_inv_")]
+                    )
+                    for table, bucket, rows in (("merchant_sales_hourly", "hour", hourly), ("merchant_sales_daily", "day", daily)):
+                        await db.executemany(
+                            f"INSERT INTO {table} (merchant_id, {bucket}, sales, stars) VALUES (?, ?, ?, ?) "
+                            f"ON CONFLICT (merchant_id, {bucket}) DO UPDATE SET "
+                            f"sales = sales + excluded.sales, stars = stars + excluded.stars",
+                            [(uid, b, count, stars) for (uid, b), (count, stars) in rows.items()]
+                        )
+        except Exception as e:
+            logger.error(f"Ошибка группового коммита ({len(batch)} записей): {e}")
+            for *_, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for uid, amount in totals.items():
+            if amount:
+                user_cache.apply(uid, lambda row, amount=amount: (row[0] + amount, *row[1:]))
+        for _, _, sale, future in batch:
+            if sale is not None:
+                processed_charges.set(sale[1], True)
+            if not future.done():
+                # Для продажи результат - было ли это первое проведение платежа
+                future.set_result(sale is None or id(sale) in fresh)
+
+    @staticmethod
+    async def _claim_charges(db, batch) -> set:
+        # Один INSERT на все платежи батча: RETURNING отдаёт только реально вставленные charge_id,
+        # так что повтор из прошлого батча и дубль внутри этого получают отказ в той же транзакции
+        claimed = {}
+        for _, _, sale, _ in batch:
+            if sale is not None and sale[1] not in claimed:
+                claimed[sale[1]] = sale
+        if not claimed:
+            return set()
+        placeholders = ", ".join("(?, ?)" for _ in claimed)
+        params = [value for charge_id, sale in claimed.items() for value in (charge_id, sale[3])]
+        async with db.execute(
+            f"INSERT OR IGNORE INTO processed_payments (charge_id, processed_at) VALUES {placeholders} RETURNING charge_id",
+            params
+        ) as cursor:
+            inserted = {row[0] async for row in cursor}
+        return {id(claimed[charge_id]) for charge_id in inserted}
+
+balance_writer = BalanceWriter(BALANCE_BATCH_WINDOW)
+
+async def ensure_user(user_id: int):
+    await balance_writer.submit(user_id, 0)
+
+async def add_balance(user_id: int, amount: int, sale: tuple = None) -> bool:
+    # Нулевое начисление - это просто регистрация пользователя, без UPDATE.
+    # С продажей возвращает False, если этот charge_id уже проводили: баланс не трогается
+    return await balance_writer.submit(user_id, amount, sale)
+
+async def is_payment_processed(charge_id: str) -> bool:
+    if processed_charges.get(charge_id):
+        return True
+    async with db_pool.read() as db:
+        async with db.execute("SELECT 1 FROM processed_payments WHERE charge_id = ?", (charge_id,)) as cursor:
+            return await cursor.fetchone() is not None
+
+@db_timed
+async def get_sales_stats(merchant_id: int) -> dict:
+    # Всё считается по агрегатам: число строк ограничено числом бакетов, а не продаж
+    now = int(time.time())
+    day, hour = now // 86400, now // 3600
+    async with db_pool.read() as db:
+        async with db.execute("""
+            SELECT
+                COALESCE(SUM(CASE WHEN day = ? THEN sales END), 0), COALESCE(SUM(CASE WHEN day = ? THEN stars END), 0),
+                COALESCE(SUM(CASE WHEN day > ? THEN sales END), 0), COALESCE(SUM(CASE WHEN day > ? THEN stars END), 0),
+                COALESCE(SUM(CASE WHEN day > ? THEN sales END), 0), COALESCE(SUM(CASE WHEN day > ? THEN stars END), 0),
+                COALESCE(SUM(sales), 0), COALESCE(SUM(stars), 0)
+            FROM merchant_sales_daily WHERE merchant_id = ?
+        """, (day, day, day - 7, day - 7, day - 30, day - 30, merchant_id)) as cursor:
+            row = await cursor.fetchone()
+        async with db.execute(
+            "SELECT COALESCE(SUM(sales), 0), COALESCE(SUM(stars), 0) FROM merchant_sales_hourly WHERE merchant_id = ? AND hour > ?",
+            (merchant_id, hour - 24)
+        ) as cursor:
+            last_24h = await cursor.fetchone()
+    return {
+        "24h": last_24h,
+        "today": row[0:2],
+        "7d": row[2:4],
+        "30d": row[4:6],
+        "total": row[6:8],
+    }
+
+@db_timed
 async def save_payment_details(user_id: int, method: str, number: str, bank: str = None):
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with db_pool.write() as db:
         await db.execute("INSERT OR IGNORE INTO users (user_id, balance) VALUES (?, 0)", (user_id,))
         await db.execute("""
             UPDATE users 
             SET payment_method = ?, payment_number = ?, payment_bank = ? 
             WHERE user_id = ?
         """, (method, number, bank, user_id))
-        await db.commit()
+    user_cache.apply(user_id, lambda row: (row[0], method, number, bank))
 
-async def reset_balance_safe(user_id: int) -> int:
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute("BEGIN")
-        async with db.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,)) as cursor:
+outbox_wakeup = asyncio.Event()
+
+async def enqueue_outbox(db, kind: str, payloads: list):
+    # Вызывается внутри чужой транзакции: сообщение появится ровно тогда, когда закоммитится изменение
+    now = int(time.time())
+    await db.executemany(
+        "INSERT INTO outbox (kind, payload, next_attempt_at, created_at) VALUES (?, ?, ?, ?)",
+        [(kind, json.dumps(payload, ensure_ascii=False), now, now) for payload in payloads]
+    )
+
+@db_timed
+async def create_withdrawal(user_id: int, details: str, message_id: int, first_name: str):
+    # Заявка, списание и уведомление админа - одна транзакция: потерять деньги "между шагами" нельзя.
+    # Сумма берётся из баланса в БД, а не из кэша, поэтому двойной клик второй раз ничего не спишет
+    async with db_pool.write() as db:
+        async with db.execute("""
+            INSERT INTO withdrawals (user_id, amount, rub_amount, details, user_message_id, status)
+            SELECT user_id, balance, CAST(balance * ? AS INTEGER), ?, ?, 'wait' FROM users
+            WHERE user_id = ? AND CAST(balance * ? AS INTEGER) >= ?
+            RETURNING id, amount, rub_amount
+        """, (XTR_TO_RUB_RATE, details, message_id, user_id, XTR_TO_RUB_RATE, MIN_WITHDRAWAL_RUB)) as cursor:
             row = await cursor.fetchone()
-            if not row or row[0] <= 0:
-                await db.rollback()
-                return 0
-            amount = row[0]
-        
-        await db.execute("UPDATE users SET balance = 0 WHERE user_id = ?", (user_id,))
-        await db.commit()
-        return amount
+        if row is None:
+            return None
+        wd_id, amount, rub_amount = row
+        await db.execute("UPDATE users SET balance = balance - ? WHERE user_id = ?", (amount, user_id))
+        await enqueue_outbox(db, "admin_withdrawal", [{
+            "wd_id": wd_id, "user_id": user_id, "first_name": first_name,
+            "amount": amount, "rub_amount": rub_amount, "details": details,
+        }])
+    user_cache.apply(user_id, lambda row: (row[0] - amount, *row[1:]))
+    outbox_wakeup.set()
+    return row
+
+@db_timed
+async def get_withdrawal(wd_id: int):
+    async with db_pool.read() as db:
+        async with db.execute("SELECT user_id, amount, user_message_id, status FROM withdrawals WHERE id = ?", (wd_id,)) as cursor:
+            return await cursor.fetchone()
 
-async def create_withdrawal(user_id: int, amount: int, rub_amount: int, details: str, message_id: int):
-    async with aiosqlite.connect(DB_NAME) as db:
+@db_timed
+async def update_withdrawal_status(wd_id: int, new_status: str):
+    async with db_pool.write() as db:
+        async with db.execute(
+            "UPDATE withdrawals SET status = ? WHERE id = ? RETURNING user_id, amount, user_message_id",
+            (new_status, wd_id)
+        ) as cursor:
+            row = await cursor.fetchone()
+        if row:
+            await enqueue_outbox(db, "withdrawal_status", [{
+                "wd_id": wd_id, "user_id": row[0], "amount": row[1], "message_id": row[2], "status": new_status,
+            }])
+    outbox_wakeup.set()
+
+async def iter_user_withdrawals(user_id: int, before_id: int = 0, limit: int = HISTORY_PAGE):
+    # Keyset от новых к старым по индексу (user_id, id): страница стоит одинаково на любой глубине истории
+    async with db_pool.read() as db:
+        async with db.execute(
+            "SELECT id, amount, rub_amount, status FROM withdrawals WHERE user_id = ? AND id < ? ORDER BY id DESC LIMIT ?",
+            (user_id, before_id or 2 ** 63 - 1, limit)
+        ) as cursor:
+            async for row in cursor:
+                yield row
+
+@db_timed
+async def list_withdrawals(status: str, after_id: int = 0, limit: int = ADMIN_QUEUE_PAGE):
+    # Keyset-пагинация: следующая страница начинается после последнего показанного id
+    async with db_pool.read() as db:
+        async with db.execute(
+            "SELECT id, user_id, amount, rub_amount, details FROM withdrawals WHERE status = ? AND id > ? ORDER BY id LIMIT ?",
+            (status, after_id, limit)
+        ) as cursor:
+            return await cursor.fetchall()
+
+@db_timed
+async def bulk_update_withdrawal_status(from_status: str, to_status: str, first_id: int, last_id: int):
+    async with db_pool.write() as db:
+        async with db.execute(
+            "UPDATE withdrawals SET status = ? WHERE status = ? AND id BETWEEN ? AND ? "
+            "RETURNING id, user_id, amount, user_message_id",
+            (to_status, from_status, first_id, last_id)
+        ) as cursor:
+            rows = await cursor.fetchall()
+        # Массовые уведомления идут с пониженным приоритетом и ограничением скорости
+        await enqueue_outbox(db, "withdrawal_status", [
+            {"wd_id": wd_id, "user_id": user_id, "amount": amount, "message_id": user_msg_id, "status": to_status, "bulk": True}
+            for wd_id, user_id, amount, user_msg_id in rows
+        ])
+    outbox_wakeup.set()
+    return rows
+
+@db_timed
+async def claim_outbox(limit: int = OUTBOX_BATCH):
+    # Забранные сообщения прячутся на OUTBOX_LEASE: если воркер упадёт, их доставит следующий
+    now = int(time.time())
+    async with db_pool.write() as db:
+        async with db.execute("""
+            UPDATE outbox SET attempts = attempts + 1, next_attempt_at = ?
+            WHERE id IN (SELECT id FROM outbox WHERE next_attempt_at <= ? ORDER BY next_attempt_at, id LIMIT ?)
+            RETURNING id, kind, payload, attempts
+        """, (now + OUTBOX_LEASE, now, limit)) as cursor:
+            rows = await cursor.fetchall()
+    return sorted(rows)
+
+@db_timed
+async def settle_outbox(done_ids: list, retries: list):
+    async with db_pool.write() as db:
+        await db.executemany("DELETE FROM outbox WHERE id = ?", [(outbox_id,) for outbox_id in done_ids])
+        await db.executemany("UPDATE outbox SET next_attempt_at = ? WHERE id = ?", retries)
+
+@db_timed
+async def create_broadcast(source_chat_id: int, source_message_id: int, status_message_id: int) -> int:
+    now = int(time.time())
+    async with db_pool.write() as db:
         cursor = await db.execute(
-            "INSERT INTO withdrawals (user_id, amount, rub_amount, details, user_message_id, status) VALUES (?, ?, ?, ?, ?, ?)",
-            (user_id, amount, rub_amount, details, message_id, 'wait')
+            "INSERT INTO broadcasts (source_chat_id, source_message_id, status_message_id, heartbeat_at, created_at) VALUES (?, ?, ?, ?, ?)",
+            (source_chat_id, source_message_id, status_message_id, now, now)
         )
-        await db.commit()
         return cursor.lastrowid
 
-async def get_withdrawal(wd_id: int):
-    async with aiosqlite.connect(DB_NAME) as db:
-        async with db.execute("SELECT user_id, amount, user_message_id, status FROM withdrawals WHERE id = ?", (wd_id,)) as cursor:
+@db_timed
+async def get_broadcast(bc_id: int):
+    async with db_pool.read() as db:
+        async with db.execute(
+            "SELECT source_chat_id, source_message_id, status_message_id, status, last_user_id, sent, blocked, failed "
+            "FROM broadcasts WHERE id = ?", (bc_id,)
+        ) as cursor:
             return await cursor.fetchone()
 
-async def update_withdrawal_status(wd_id: int, new_status: str):
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute("UPDATE withdrawals SET status = ? WHERE id = ?", (new_status, wd_id))
-        await db.commit()
+@db_timed
+async def claim_broadcasts(lease: int) -> list:
+    # Незавершённые рассылки, которые никто не продвигал дольше lease, забираем себе
+    now = int(time.time())
+    async with db_pool.write() as db:
+        async with db.execute(
+            "UPDATE broadcasts SET heartbeat_at = ? WHERE status = 'running' AND heartbeat_at <= ? RETURNING id",
+            (now, now - lease)
+        ) as cursor:
+            return sorted(row[0] for row in await cursor.fetchall())
+
+@db_timed
+async def checkpoint_broadcast(bc_id: int, last_user_id: int, sent: int, blocked_ids: list, failed: int, finished: bool = False) -> str:
+    # Прогресс и отметки о блокировке пишутся вместе: после рестарта продолжим со следующего пользователя
+    async with db_pool.write() as db:
+        await db.executemany("UPDATE users SET blocked = 1 WHERE user_id = ?", [(user_id,) for user_id in blocked_ids])
+        async with db.execute("""
+            UPDATE broadcasts SET last_user_id = ?, sent = sent + ?, blocked = blocked + ?, failed = failed + ?, heartbeat_at = ?,
+                status = CASE WHEN ? AND status = 'running' THEN 'done' ELSE status END
+            WHERE id = ? RETURNING status
+        """, (last_user_id, sent, len(blocked_ids), failed, int(time.time()), finished, bc_id)) as cursor:
+            row = await cursor.fetchone()
+    return row[0]
+
+@db_timed
+async def cancel_broadcast(bc_id: int):
+    async with db_pool.write() as db:
+        await db.execute("UPDATE broadcasts SET status = 'cancelled' WHERE id = ? AND status = 'running'", (bc_id,))
+
+async def iter_broadcast_recipients(after_user_id: int = 0, page: int = BROADCAST_PAGE):
+    # Keyset по первичному ключу: в памяти одна страница, соединение читателя между страницами не держим
+    while True:
+        async with db_pool.read() as db:
+            async with db.execute(
+                "SELECT user_id FROM users WHERE user_id > ? AND blocked = 0 ORDER BY user_id LIMIT ?",
+                (after_user_id, page)
+            ) as cursor:
+                user_ids = [row[0] for row in await cursor.fetchall()]
+        if not user_ids:
+            return
+        yield user_ids
+        after_user_id = user_ids[-1]
+
+def link_key(uuid_str: str) -> bytes:
+    # 12 hex-символов превращаются в 6 байт; всё остальное храним как есть
+    try:
+        return bytes.fromhex(uuid_str)
+    except ValueError:
+        return uuid_str.encode()
+
+def current_day() -> int:
+    return int(time.time() // 86400)
 
+class BloomFilter:
+    """Отвечает «точно нет» без обращения к БД; «возможно да» проверяется по таблице."""
+
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key: bytes):
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, key: bytes):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key: bytes) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+# Фильтр живёт в памяти процесса, поэтому при нескольких воркерах (redis) всегда идём в БД
+used_links_bloom = None
+
+async def load_used_links_bloom():
+    global used_links_bloom
+    if STATE_BACKEND != "memory":
+        return
+    async with db_pool.read() as db:
+        async with db.execute("SELECT count(*) FROM used_links") as cursor:
+            (count,) = await cursor.fetchone()
+        bloom = BloomFilter(max(USED_LINKS_BLOOM_CAPACITY, count * 2))
+        async with db.execute("SELECT link_id FROM used_links") as cursor:
+            async for (link_id,) in cursor:
+                bloom.add(link_id)
+    used_links_bloom = bloom
+    logger.info(f"Bloom-фильтр ссылок: {count} записей")
+
+@db_timed
 async def is_link_used(uuid_str: str) -> bool:
-    async with aiosqlite.connect(DB_NAME) as db:
-        async with db.execute("SELECT 1 FROM used_links WHERE link_uuid = ?", (uuid_str,)) as cursor:
+    key = link_key(uuid_str)
+    if used_links_bloom is not None and key not in used_links_bloom:
+        return False
+    async with db_pool.read() as db:
+        async with db.execute("SELECT 1 FROM used_links WHERE link_id = ?", (key,)) as cursor:
             return bool(await cursor.fetchone())
 
+@db_timed
 async def mark_link_used(uuid_str: str):
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute("INSERT OR IGNORE INTO used_links (link_uuid) VALUES (?)", (uuid_str,))
-        await db.commit()
+    key = link_key(uuid_str)
+    if used_links_bloom is not None:
+        used_links_bloom.add(key)
+    async with db_pool.write() as db:
+        await db.execute("INSERT OR IGNORE INTO used_links (link_id, used_day) VALUES (?, ?)", (key, current_day()))
+
+async def prune_used_links(interval: float = 3600):
+    # Ссылки старше срока хранения снова будут считаться неиспользованными - включать осознанно
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            async with db_pool.write() as db:
+                cursor = await db.execute(
+                    "DELETE FROM used_links WHERE used_day < ?",
+                    (current_day() - USED_LINKS_RETENTION_DAYS,)
+                )
+            if cursor.rowcount:
+                logger.info(f"Удалено старых ссылок: {cursor.rowcount}")
+        except Exception as e:
+            logger.error(f"Ошибка очистки ссылок: {e}")
+
+# ------------------- ХРАНИЛИЩЕ -------------------
+class TTLCache:
+    """Ограниченный LRU-кэш с временем жизни записей."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            return default
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def expire(self) -> int:
+        now = time.monotonic()
+        stale = [key for key, (expires_at, _) in self._data.items() if expires_at < now]
+        for key in stale:
+            del self._data[key]
+        return len(stale)
+
+    def __len__(self):
+        return len(self._data)
+
+class UserCache:
+    """Кэш строк users с чтением через кэш; параллельные промахи по одному пользователю дают один запрос в БД."""
+
+    def __init__(self, maxsize: int, ttl: float, enabled: bool = True):
+        self.cache = TTLCache(maxsize, ttl)
+        self.enabled = enabled
+        self.loading = {}
+        self.stale = set()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    async def get(self, user_id: int, loader):
+        if not self.enabled:
+            return await loader(user_id)
+        row = self.cache.get(user_id)
+        if row is not None:
+            self.hits += 1
+            return row
+        future = self.loading.get(user_id)
+        if future is not None:
+            self.coalesced += 1
+            return await asyncio.shield(future)
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self.loading[user_id] = future
+        try:
+            row = await loader(user_id)
+            # Пока читали, запись могли изменить - такую строку не кэшируем
+            if row is not None and user_id not in self.stale:
+                self.cache.set(user_id, row)
+            future.set_result(row)
+            return row
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()
+            raise
+        finally:
+            del self.loading[user_id]
+            self.stale.discard(user_id)
+
+    def apply(self, user_id: int, change):
+        """Вызывается после коммита: обновляет закэшированную строку на месте."""
+        if user_id in self.loading:
+            self.stale.add(user_id)
+        row = self.cache.get(user_id)
+        if row is not None:
+            self.cache.set(user_id, change(row))
+
+    def invalidate(self, user_id: int):
+        if user_id in self.loading:
+            self.stale.add(user_id)
+        self.cache.pop(user_id)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses + self.coalesced
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "hit_rate": self.hits / total if total else 0.0,
+            "size": len(self.cache),
+        }
+
+# С несколькими воркерами кэш одного процесса устаревал бы от чужих записей
+user_cache = UserCache(USER_CACHE_SIZE, USER_CACHE_TTL, enabled=STATE_BACKEND == "memory")
+
+class UserNameCache:
+    """Имена пользователей из входящих апдейтов: память, затем users; к Telegram идём только за устаревшими и в фоне."""
+
+    def __init__(self, maxsize: int, ttl: int, flush_interval: float):
+        self.cache = TTLCache(maxsize, ttl)  # user_id -> (first_name, когда имя получено)
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.dirty = {}
+        self.refresh_queue = set()
+
+    def observe(self, user: types.User):
+        now = int(time.time())
+        cached = self.cache.get(user.id)
+        if cached is not None and cached[0] == user.first_name and now - cached[1] < self.ttl:
+            return
+        self.cache.set(user.id, (user.first_name, now))
+        self.dirty[user.id] = (user.first_name, now)
+        self.refresh_queue.discard(user.id)
+
+    @db_timed
+    async def _fetch(self, user_id: int):
+        async with db_pool.read() as db:
+            async with db.execute("SELECT first_name, name_updated_at FROM users WHERE user_id = ?", (user_id,)) as cursor:
+                row = await cursor.fetchone()
+        return tuple(row) if row and row[0] else None
+
+    async def get(self, user_id: int):
+        cached = self.cache.get(user_id)
+        if cached is None:
+            cached = await self._fetch(user_id)
+            if cached is None:
+                # Пользователя ещё ни разу не видели - единственный случай, когда ждём Telegram
+                chat = await bot.get_chat(user_id)
+                cached = (chat.first_name, int(time.time()))
+                self.dirty[user_id] = cached
+            self.cache.set(user_id, cached)
+        if time.time() - cached[1] >= self.ttl:
+            # Отдаём что есть, свежее имя подтянем в фоне
+            self.refresh_queue.add(user_id)
+        return cached[0]
+
+    async def flush(self):
+        if not self.dirty:
+            return
+        batch, self.dirty = self.dirty, {}
+        try:
+            # Незарегистрированных (без /start) не добавляем: их имя живёт только в памяти
+            async with db_pool.write() as db:
+                await db.executemany(
+                    "UPDATE users SET first_name = ?, name_updated_at = ? WHERE user_id = ?",
+                    [(name, updated_at, user_id) for user_id, (name, updated_at) in batch.items()]
+                )
+        except Exception as e:
+            logger.error(f"Ошибка записи имён ({len(batch)}): {e}")
+            self._requeue(batch)
+        except BaseException:
+            # stop_background() отменил run() посреди записи: пачку допишет финальный flush
+            self._requeue(batch)
+            raise
+
+    def _requeue(self, batch: dict):
+        for user_id, record in batch.items():
+            self.dirty.setdefault(user_id, record)
+
+    async def refresh(self, limit: int = 20):
+        for user_id in list(itertools.islice(self.refresh_queue, limit)):
+            self.refresh_queue.discard(user_id)
+            try:
+                with outbound_priority(PRIORITY_BULK):
+                    chat = await bot.get_chat(user_id)
+            except Exception as e:
+                logger.warning(f"Не удалось обновить имя {user_id}: {e}")
+                continue
+            record = (chat.first_name, int(time.time()))
+            self.cache.set(user_id, record)
+            self.dirty[user_id] = record
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.refresh()
+            await self.flush()
+            self.cache.expire()
+
+user_names = UserNameCache(USER_NAME_CACHE_SIZE, USER_NAME_TTL, USER_NAME_FLUSH_INTERVAL)
+
+class UserNameMiddleware(BaseMiddleware):
+    """Запоминает имя отправителя каждого апдейта - оно и так приходит в from_user."""
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is not None and not user.is_bot:
+            user_names.observe(user)
+        return await handler(event, data)
+
+class CodeAllocator:
+    """Выдача кодов оплаты за O(1): перемешанный пул свободных кодов и колесо таймеров для TTL."""
+
+    def __init__(self, length: int, ttl: float, long_length: int, long_threshold: float, tick: float = 1.0):
+        self.length = length
+        self.long_length = long_length
+        self.long_threshold = long_threshold
+        self.capacity = 10 ** length
+        self.free = [str(i).zfill(length) for i in range(self.capacity)]
+        random.shuffle(self.free)
+        self.sessions = {}
+        # Колесо таймеров: код попадает в слот, который сработает через ttl
+        self.tick = tick
+        self.ttl_ticks = max(1, int(ttl / tick))
+        self.wheel = [set() for _ in range(self.ttl_ticks + 1)]
+        self.cursor = 0
+        self.slot_of = {}
+
+    def utilization(self) -> float:
+        return 1 - len(self.free) / self.capacity
+
+    def allocate(self, session: dict) -> str:
+        if self.free and self.utilization() < self.long_threshold:
+            code = self.free.pop()
+        else:
+            # Короткие коды почти кончились - выдаём длинные, их пространство на порядки больше
+            while True:
+                code = str(random.randrange(10 ** self.long_length)).zfill(self.long_length)
+                if code not in self.sessions:
+                    break
+        self.sessions[code] = session
+        slot = (self.cursor + self.ttl_ticks) % len(self.wheel)
+        self.wheel[slot].add(code)
+        self.slot_of[code] = slot
+        return code
+
+    def get(self, code: str):
+        return self.sessions.get(code)
+
+    def release(self, code: str, user_id: int = None):
+        session = self.sessions.get(code)
+        # Код мог истечь и уйти другому пользователю - чужую сессию не трогаем
+        if session is None or (user_id is not None and session["user_id"] != user_id):
+            return
+        del self.sessions[code]
+        self.wheel[self.slot_of.pop(code)].discard(code)
+        if len(code) == self.length:
+            self.free.append(code)
+            # Меняем местами с случайным свободным, чтобы освобождённый код не выдавался следующим
+            j = random.randrange(len(self.free))
+            self.free[-1], self.free[j] = self.free[j], self.free[-1]
+
+    def sweep(self) -> int:
+        self.cursor = (self.cursor + 1) % len(self.wheel)
+        expired = list(self.wheel[self.cursor])
+        for code in expired:
+            self.release(code)
+        return len(expired)
+
+    async def run_sweeper(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            self.sweep()
+
+
+INVOICE_FIELDS = (
+    "merchant_id", "merchant_msg_id", "payer_id", "payer_prompt_msg_id",
+    "invoice_msg_id", "link_uuid", "original_chat_id", "original_msg_id"
+)
+invoice_cache = TTLCache(INVOICE_CACHE_SIZE, PENDING_INVOICE_TTL)
+processed_charges = TTLCache(PROCESSED_CHARGES_CACHE, 86400)
+
+class PendingInvoiceWriter:
+    """Изменения неоплаченных счетов пишутся в SQLite пачкой в фоне: счёт живёт в памяти, база нужна после рестарта."""
+
+    def __init__(self, flush_interval: float):
+        self.flush_interval = flush_interval
+        self.dirty = {}  # payload -> ("save", данные) | ("update", поля) | ("delete", None)
+        self.flushing = {}  # Пишутся прямо сейчас: до коммита читаем их, а не БД
+
+    def peek(self, payload: str):
+        for pending in (self.dirty, self.flushing):
+            if payload in pending:
+                return pending[payload]
+        return None
+
+    def save(self, payload: str, data: dict):
+        self.dirty[payload] = ("save", dict(data))
+
+    def update(self, payload: str, fields: dict):
+        # Удалённый счёт не воскрешаем, к несохранённому просто дописываем поля
+        if (self.peek(payload) or ("update",))[0] == "delete":
+            return
+        op, value = self.dirty.get(payload, ("update", {}))
+        self.dirty[payload] = (op, {**value, **fields})
+
+    def delete(self, payload: str):
+        self.dirty[payload] = ("delete", None)
+
+    @db_timed
+    async def flush(self):
+        if not self.dirty:
+            return
+        self.flushing, self.dirty = self.dirty, {}
+        now = int(time.time())
+        saves, updates, deletes = [], {}, []
+        for payload, (op, value) in self.flushing.items():
+            if op == "save":
+                saves.append((payload, *(value.get(field) for field in INVOICE_FIELDS), now))
+            elif op == "update":
+                updates.setdefault(tuple(value), []).append((*value.values(), payload))
+            else:
+                deletes.append((payload,))
+        try:
+            async with db_pool.write() as db:
+                await db.executemany(
+                    f"INSERT OR REPLACE INTO pending_invoices (payload, {', '.join(INVOICE_FIELDS)}, created_at) "
+                    f"VALUES (?, {', '.join('?' * len(INVOICE_FIELDS))}, ?)",
+                    saves
+                )
+                # Только UPDATE: оплаченный и уже удалённый счёт не должен воскреснуть
+                for fields, rows in updates.items():
+                    await db.executemany(
+                        f"UPDATE pending_invoices SET {', '.join(f'{field} = ?' for field in fields)} WHERE payload = ?",
+                        rows
+                    )
+                await db.executemany("DELETE FROM pending_invoices WHERE payload = ?", deletes)
+        except Exception as e:
+            logger.error(f"Ошибка записи счетов ({len(self.flushing)}): {e}")
+            self._requeue()
+        except BaseException:
+            # Отмена посреди записи (остановка): пачку допишет финальный flush
+            self._requeue()
+            raise
+        finally:
+            self.flushing = {}
+
+    def _requeue(self):
+        # Более новая запись по тому же счёту важнее; поля поверх несохранённого счёта сливаем с ним
+        for payload, (op, value) in self.flushing.items():
+            newer = self.dirty.get(payload)
+            if newer is None:
+                self.dirty[payload] = (op, value)
+            elif newer[0] == "update":
+                self.dirty[payload] = (op, None) if op == "delete" else (op, {**value, **newer[1]})
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+pending_invoice_writer = PendingInvoiceWriter(PENDING_INVOICE_FLUSH_INTERVAL)
+
+async def save_pending_invoice(payload: str, data: dict):
+    data = {field: data.get(field) for field in INVOICE_FIELDS}
+    invoice_cache.set(payload, data)
+    pending_invoice_writer.save(payload, data)
+
+async def update_pending_invoice(payload: str, fields: dict):
+    data = invoice_cache.get(payload)
+    if data is not None:
+        data.update(fields)
+    pending_invoice_writer.update(payload, fields)
+
+@db_timed
+async def get_pending_invoice(payload: str):
+    data = invoice_cache.get(payload)
+    if data is not None:
+        return data
+    # Промах кэша: счёт мог быть выставлен до рестарта или вытеснен из памяти
+    async with db_pool.read() as db:
+        async with db.execute(
+            f"SELECT {', '.join(INVOICE_FIELDS)} FROM pending_invoices WHERE payload = ? AND created_at >= ?",
+            (payload, int(time.time()) - PENDING_INVOICE_TTL)
+        ) as cursor:
+            row = await cursor.fetchone()
+    # Незаписанные изменения новее того, что лежит в БД
+    op, value = pending_invoice_writer.peek(payload) or (None, None)
+    if op == "delete":
+        return None
+    if op == "save":
+        data = dict(value)
+    elif row:
+        data = dict(zip(INVOICE_FIELDS, row))
+        if op == "update":
+            data.update(value)
+    else:
+        return None
+    invoice_cache.set(payload, data)
+    return data
+
+async def delete_pending_invoice(payload: str):
+    invoice_cache.pop(payload)
+    pending_invoice_writer.delete(payload)
+
+@db_timed
+async def save_invoice_links(merchant_id: int, amount: int, links: list):
+    now = int(time.time())
+    async with db_pool.write() as db:
+        await db.executemany(
+            "INSERT INTO invoice_links (payload, merchant_id, amount, url, created_at) VALUES (?, ?, ?, ?, ?)",
+            [(payload, merchant_id, amount, url, now) for payload, url in links]
+        )
+
+@db_timed
+async def claim_invoice_link(merchant_id: int, amount: int):
+    async with db_pool.write() as db:
+        async with db.execute(
+            "UPDATE invoice_links SET issued_at = ? WHERE payload = ("
+            "  SELECT payload FROM invoice_links WHERE merchant_id = ? AND amount = ? AND issued_at IS NULL LIMIT 1"
+            ") RETURNING url",
+            (int(time.time()), merchant_id, amount)
+        ) as cursor:
+            row = await cursor.fetchone()
+    return row[0] if row else None
+
+@db_timed
+async def load_pooled_invoice_links(merchant_id: int, amount: int) -> list:
+    async with db_pool.read() as db:
+        async with db.execute(
+            "SELECT payload, url FROM invoice_links WHERE merchant_id = ? AND amount = ? AND issued_at IS NULL",
+            (merchant_id, amount)
+        ) as cursor:
+            return await cursor.fetchall()
+
+@db_timed
+async def mark_invoice_links_issued(issued: dict):
+    async with db_pool.write() as db:
+        await db.executemany(
+            "UPDATE invoice_links SET issued_at = ? WHERE payload = ?",
+            [(issued_at, payload) for payload, issued_at in issued.items()]
+        )
+
+@db_timed
+async def count_pooled_invoice_links(merchant_id: int, amount: int) -> int:
+    async with db_pool.read() as db:
+        async with db.execute(
+            "SELECT COUNT(*) FROM invoice_links WHERE merchant_id = ? AND amount = ? AND issued_at IS NULL",
+            (merchant_id, amount)
+        ) as cursor:
+            return (await cursor.fetchone())[0]
+
+@db_timed
+async def get_invoice_link(payload: str):
+    async with db_pool.read() as db:
+        async with db.execute("SELECT merchant_id, amount FROM invoice_links WHERE payload = ?", (payload,)) as cursor:
+            row = await cursor.fetchone()
+    return {"merchant_id": row[0], "amount": row[1]} if row else None
+
+async def expire_invoice_links(interval: float = 3600):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            async with db_pool.write() as db:
+                cursor = await db.execute(
+                    "DELETE FROM invoice_links WHERE COALESCE(issued_at, created_at) < ?",
+                    (int(time.time()) - INVOICE_LINK_TTL_DAYS * 86400,)
+                )
+            if cursor.rowcount:
+                logger.info(f"Удалено просроченных ссылок на оплату: {cursor.rowcount}")
+                # Просроченные могли лежать в пуле в памяти - перечитаем его из БД
+                invoice_link_pool.ready.clear()
+        except Exception as e:
+            logger.error(f"Ошибка очистки ссылок на оплату: {e}")
+
+async def expire_pending_invoices(interval: float = 600):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            invoice_cache.expire()
+            async with db_pool.write() as db:
+                cursor = await db.execute(
+                    "DELETE FROM pending_invoices WHERE created_at < ?",
+                    (int(time.time()) - PENDING_INVOICE_TTL,)
+                )
+            if cursor.rowcount:
+                logger.info(f"Удалено просроченных счетов: {cursor.rowcount}")
+        except Exception as e:
+            logger.error(f"Ошибка очистки счетов: {e}")
+
+# Фоновые задачи живут от старта до остановки бота
+background_tasks = set()
+
+def start_background(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+async def stop_background():
+    for task in list(background_tasks):
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+
+# Побочные действия после оплаты: не блокируют ответ, но учитываются
+SIDE_EFFECT_TIMEOUT = 15
+side_effect_stats = {"ok": 0, "failed": 0, "timeout": 0}
+
+async def _supervised(name: str, coro, timeout: float):
+    try:
+        await asyncio.wait_for(coro, timeout)
+        side_effect_stats["ok"] += 1
+    except asyncio.TimeoutError:
+        side_effect_stats["timeout"] += 1
+        logger.warning(f"Таймаут: {name}")
+    except Exception as e:
+        side_effect_stats["failed"] += 1
+        logger.warning(f"Ошибка: {name}: {e}")
+
+def spawn_side_effects(named_coros, timeout: float = SIDE_EFFECT_TIMEOUT):
+    for name, coro in named_coros:
+        start_background(_supervised(name, coro, timeout))
+
+class StateBackend(ABC):
+    """Где живут коды оплаты и неоплаченные счета. Хэндлеры работают только через этот интерфейс."""
+
+    async def start(self):
+        pass
+
+    @abstractmethod
+    async def allocate_code(self, session: dict) -> str:
+        ...
+
+    @abstractmethod
+    async def get_session(self, code: str):
+        ...
+
+    @abstractmethod
+    async def update_session(self, code: str, **fields):
+        ...
+
+    @abstractmethod
+    async def release_code(self, code: str, user_id: int = None):
+        ...
+
+    @abstractmethod
+    async def save_invoice(self, payload: str, data: dict):
+        ...
+
+    @abstractmethod
+    async def get_invoice(self, payload: str):
+        ...
+
+    @abstractmethod
+    async def update_invoice(self, payload: str, **fields):
+        """Дописывает id сообщений в уже сохранённый счёт; удалённый счёт не трогает."""
+
+    @abstractmethod
+    async def delete_invoice(self, payload: str):
+        ...
+
+    @abstractmethod
+    async def reserve_invoice(self, payload: str, payer_id: int) -> bool:
+        """Закрепляет многоразовую ссылку за плательщиком на время оплаты; False - её уже оплачивает другой."""
+
+class MemoryStateBackend(StateBackend):
+    """Один процесс: коды в памяти, счета в SQLite с кэшем."""
+
+    def __init__(self, allocator: CodeAllocator):
+        self.allocator = allocator
+        self.reservations = TTLCache(100000, INVOICE_RESERVE_TTL)
+
+    async def start(self):
+        start_background(self.allocator.run_sweeper())
+        start_background(expire_pending_invoices())
+        start_background(pending_invoice_writer.run())
+
+    async def allocate_code(self, session: dict) -> str:
+        return self.allocator.allocate(dict(session))
+
+    async def get_session(self, code: str):
+        session = self.allocator.get(code)
+        return dict(session) if session else None
+
+    async def update_session(self, code: str, **fields):
+        session = self.allocator.get(code)
+        if session:
+            session.update(fields)
+
+    async def release_code(self, code: str, user_id: int = None):
+        self.allocator.release(code, user_id)
+
+    async def save_invoice(self, payload: str, data: dict):
+        await save_pending_invoice(payload, data)
+
+    async def get_invoice(self, payload: str):
+        return await get_pending_invoice(payload)
 
-# ------------------- ХРАНИЛИЩЕ (RAM) -------------------
-active_sessions = {} 
-merchant_transactions = {}
+    async def update_invoice(self, payload: str, **fields):
+        await update_pending_invoice(payload, fields)
+
+    async def delete_invoice(self, payload: str):
+        await delete_pending_invoice(payload)
+
+    async def reserve_invoice(self, payload: str, payer_id: int) -> bool:
+        owner = self.reservations.get(payload)
+        if owner is not None and owner != payer_id:
+            return False
+        self.reservations.set(payload, payer_id)
+        return True
+
+class RedisStateBackend(StateBackend):
+    """Несколько воркеров: пул кодов, сессии и счета лежат в Redis."""
+
+    def __init__(self, redis, prefix: str = "platilka"):
+        self.redis = redis
+        self.prefix = prefix
+        self.capacity = 10 ** CODE_LENGTH
+
+    def _key(self, name: str) -> str:
+        return f"{self.prefix}:{name}"
+
+    async def start(self):
+        # Пул коротких кодов заполняет только первый запустившийся воркер
+        if await self.redis.set(self._key("codes:init"), 1, nx=True):
+            await self.redis.sadd(self._key("codes:free"), *(str(i).zfill(CODE_LENGTH) for i in range(self.capacity)))
+        start_background(self._sweep_loop())
+
+    async def allocate_code(self, session: dict) -> str:
+        code = None
+        if await self.redis.scard(self._key("codes:free")) > self.capacity * (1 - LONG_CODE_THRESHOLD):
+            code = await self.redis.spop(self._key("codes:free"))
+        if code is not None:
+            await self.redis.set(self._key(f"session:{code}"), json.dumps(session), ex=CODE_TTL)
+        else:
+            while True:
+                code = str(random.randrange(10 ** LONG_CODE_LENGTH)).zfill(LONG_CODE_LENGTH)
+                if await self.redis.set(self._key(f"session:{code}"), json.dumps(session), ex=CODE_TTL, nx=True):
+                    break
+        await self.redis.zadd(self._key("codes:leases"), {code: time.time() + CODE_TTL})
+        return code
+
+    async def get_session(self, code: str):
+        raw = await self.redis.get(self._key(f"session:{code}"))
+        return json.loads(raw) if raw else None
+
+    async def update_session(self, code: str, **fields):
+        session = await self.get_session(code)
+        if session:
+            session.update(fields)
+            await self.redis.set(self._key(f"session:{code}"), json.dumps(session), keepttl=True)
+
+    async def release_code(self, code: str, user_id: int = None):
+        session = await self.get_session(code)
+        if session is None or (user_id is not None and session["user_id"] != user_id):
+            return
+        await self.redis.delete(self._key(f"session:{code}"))
+        await self._return_code(code)
+
+    async def _return_code(self, code: str):
+        # ZREM удаётся только одному воркеру, так что код не вернётся в пул дважды
+        if await self.redis.zrem(self._key("codes:leases"), code) and len(code) == CODE_LENGTH:
+            await self.redis.sadd(self._key("codes:free"), code)
+
+    async def _sweep_loop(self, interval: float = 5):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                expired = await self.redis.zrangebyscore(self._key("codes:leases"), 0, time.time(), start=0, num=1000)
+                for code in expired:
+                    await self._return_code(code)
+            except Exception as e:
+                logger.error(f"Ошибка очистки кодов: {e}")
+
+    async def save_invoice(self, payload: str, data: dict):
+        data = {field: data.get(field) for field in INVOICE_FIELDS}
+        await self.redis.set(self._key(f"invoice:{payload}"), json.dumps(data), ex=PENDING_INVOICE_TTL)
+
+    async def get_invoice(self, payload: str):
+        raw = await self.redis.get(self._key(f"invoice:{payload}"))
+        return json.loads(raw) if raw else None
+
+    async def update_invoice(self, payload: str, **fields):
+        data = await self.get_invoice(payload)
+        if data:
+            data.update(fields)
+            await self.redis.set(self._key(f"invoice:{payload}"), json.dumps(data), keepttl=True, xx=True)
+
+    async def delete_invoice(self, payload: str):
+        await self.redis.delete(self._key(f"invoice:{payload}"))
+
+    async def reserve_invoice(self, payload: str, payer_id: int) -> bool:
+        key = self._key(f"reserve:{payload}")
+        if await self.redis.set(key, payer_id, ex=INVOICE_RESERVE_TTL, nx=True):
+            return True
+        return await self.redis.get(key) == str(payer_id)
+
+class SQLiteStorage(BaseStorage):
+    """FSM в той же SQLite: недавние состояния в TTLCache, изменения пишутся пачкой раз в flush_interval."""
+
+    def __init__(self, cache_size: int, cache_ttl: float, flush_interval: float, state_ttl: int):
+        self.cache = TTLCache(cache_size, cache_ttl)
+        self.dirty = {}  # Ещё не записанные изменения; из кэша их вытеснить нельзя
+        self.flushing = {}  # Пишутся прямо сейчас: до коммита читаем их, а не БД
+        self.flush_interval = flush_interval
+        self.state_ttl = state_ttl
+        self.last_cleanup = 0.0
+        self.task = None
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:{key.business_connection_id or ''}:{key.destiny}"
+
+    def _peek(self, k: str):
+        for pending in (self.dirty, self.flushing):
+            if k in pending:
+                return pending[k]
+        return self.cache.get(k)
+
+    @db_timed
+    async def _fetch(self, k: str) -> tuple:
+        async with db_pool.read() as db:
+            async with db.execute("SELECT state, data FROM fsm_states WHERE key = ?", (k,)) as cursor:
+                row = await cursor.fetchone()
+        return (row[0], json.loads(row[1])) if row else (None, {})
+
+    async def _load(self, key: StorageKey) -> tuple:
+        k = self._key(key)
+        record = self._peek(k)
+        if record is not None:
+            return record
+        record = await self._fetch(k)
+        # Пока читали, состояние могли записать - старое из БД его не затирает
+        newer = self._peek(k)
+        if newer is not None:
+            return newer
+        # Пустые записи тоже кэшируем: фильтры по состоянию спрашивают его на каждом апдейте
+        self.cache.set(k, record)
+        return record
+
+    def _store(self, key: StorageKey, record: tuple):
+        k = self._key(key)
+        self.cache.set(k, record)
+        self.dirty[k] = record
+
+    async def set_state(self, key: StorageKey, state=None) -> None:
+        _, data = await self._load(key)
+        self._store(key, (state.state if isinstance(state, State) else state, data))
+
+    async def get_state(self, key: StorageKey):
+        return (await self._load(key))[0]
+
+    async def set_data(self, key: StorageKey, data: dict) -> None:
+        state, _ = await self._load(key)
+        self._store(key, (state, data.copy()))
+
+    async def get_data(self, key: StorageKey) -> dict:
+        return (await self._load(key))[1].copy()
+
+    @db_timed
+    async def flush(self):
+        if not self.dirty:
+            return
+        self.flushing, self.dirty = self.dirty, {}
+        now = int(time.time())
+        try:
+            async with db_pool.write() as db:
+                await db.executemany(
+                    "INSERT INTO fsm_states (key, state, data, updated_at) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (key) DO UPDATE SET state = excluded.state, data = excluded.data, updated_at = excluded.updated_at",
+                    [(k, state, json.dumps(data, ensure_ascii=False), now) for k, (state, data) in self.flushing.items() if state or data]
+                )
+                # state.clear() - строка больше не нужна
+                await db.executemany(
+                    "DELETE FROM fsm_states WHERE key = ?",
+                    [(k,) for k, (state, data) in self.flushing.items() if not state and not data]
+                )
+        except Exception as e:
+            logger.error(f"Ошибка записи FSM ({len(self.flushing)} состояний): {e}")
+            # Повторим в следующий раз, если за это время ключ не перезаписали
+            self._requeue()
+        except BaseException:
+            # Отмена посреди записи (остановка): транзакция откатится, пачку допишет финальный flush
+            self._requeue()
+            raise
+        finally:
+            self.flushing = {}
+
+    def _requeue(self):
+        for k, record in self.flushing.items():
+            self.dirty.setdefault(k, record)
+
+    async def cleanup(self):
+        async with db_pool.write() as db:
+            await db.execute("DELETE FROM fsm_states WHERE updated_at < ?", (int(time.time()) - self.state_ttl,))
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+            self.cache.expire()
+            if time.monotonic() - self.last_cleanup > 3600:
+                self.last_cleanup = time.monotonic()
+                try:
+                    await self.cleanup()
+                except Exception as e:
+                    logger.error(f"Ошибка очистки FSM: {e}")
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        # Dispatcher зовёт close() при остановке polling; второй вызов просто ничего не делает
+        if self.task is not None:
+            self.task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self.task
+            self.task = None
+        await self.flush()
+
+if STATE_BACKEND == "redis":
+    state_backend = RedisStateBackend(redis_client)
+    fsm_storage = RedisStorage(redis_client)
+else:
+    state_backend = MemoryStateBackend(CodeAllocator(CODE_LENGTH, CODE_TTL, LONG_CODE_LENGTH, LONG_CODE_THRESHOLD))
+    # Один процесс: FSM переживает рестарт, а в памяти только недавно активные пользователи
+    fsm_storage = SQLiteStorage(FSM_CACHE_SIZE, FSM_CACHE_TTL, FSM_FLUSH_INTERVAL, FSM_STATE_TTL_DAYS * 86400)
+
+dp = Dispatcher(storage=fsm_storage)
+dp.include_router(router)
+dp.update.outer_middleware(UserNameMiddleware())
 
 class PaymentState(StatesGroup):
     waiting_for_input = State()
@@ -164,13 +1850,281 @@ class ProfileState(StatesGroup):
     waiting_for_card = State()
     confirm_sbp = State()
 
-# ------------------- ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ -------------------
-def generate_code():
-    while True:
-        code = ''.join(random.choices(string.digits, k=CODE_LENGTH))
-        if code not in active_sessions:
-            return code
+# ------------------- ИСХОДЯЩИЕ ЗАПРОСЫ -------------------
+# Приоритеты: чем меньше число, тем раньше запрос уходит в Telegram
+PRIORITY_PAYMENT = 0
+PRIORITY_NORMAL = 1
+PRIORITY_COSMETIC = 2
+PRIORITY_BULK = 3
+
+api_priority = ContextVar("api_priority", default=None)
+
+@contextmanager
+def outbound_priority(priority: int):
+    token = api_priority.set(priority)
+    try:
+        yield
+    finally:
+        api_priority.reset(token)
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        """Забирает токен и возвращает 0, либо сколько секунд ждать до следующего."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+class PriorityBucket:
+    """Токен-бакет с очередью: токены раздаются строго по приоритету, внутри приоритета - по очереди."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.bucket = TokenBucket(rate, capacity)
+        self.waiters = []
+        self.seq = itertools.count()
+        self.pump = None
+
+    async def acquire(self, priority: int):
+        if not self.waiters and self.bucket.take() == 0:
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.seq), future))
+        if self.pump is None or self.pump.done():
+            self.pump = asyncio.create_task(self._pump())
+        await future
+
+    async def _pump(self):
+        while self.waiters:
+            if self.waiters[0][2].done():
+                heapq.heappop(self.waiters)
+                continue
+            wait = self.bucket.take()
+            if wait:
+                await asyncio.sleep(wait)
+                continue
+            heapq.heappop(self.waiters)[2].set_result(None)
+
+def sends_message(method) -> bool:
+    # Лимиты Telegram «сообщений в чат» касаются только новых сообщений; правки, удаления и getChat их не тратят
+    return type(method).__name__.startswith(("Send", "Copy", "Forward"))
+
+class OutboundScheduler(BaseRequestMiddleware):
+    """Все запросы к Bot API идут через общий лимит по приоритету, новые сообщения - ещё и через лимит чата.
+
+    Лимиты считаются в пределах одного процесса: при STATE_BACKEND=redis каждый из N воркеров
+    отправляет до API_GLOBAL_RATE в секунду, поэтому для N воркеров лимиты нужно делить на N.
+    """
+
+    def __init__(self, global_rate: float, chat_rate: float, group_rate: float, burst: float, max_retries: int):
+        self.global_bucket = PriorityBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.chat_buckets = TTLCache(100000, 60)
+        # Последняя правка каждого сообщения; держим и после отправки, чтобы отставшие забрали её результат
+        self.latest_edits = TTLCache(100000, 60)
+        self.stats = {"retry_after": 0, "coalesced": 0}
+
+    @staticmethod
+    def priority_of(method) -> int:
+        priority = api_priority.get()
+        if priority is not None:
+            return priority
+        if isinstance(method, (SendInvoice, AnswerPreCheckoutQuery)):
+            return PRIORITY_PAYMENT
+        if isinstance(method, (EditMessageText, EditMessageReplyMarkup, DeleteMessage)):
+            return PRIORITY_COSMETIC
+        return PRIORITY_NORMAL
+
+    async def _chat_slot(self, chat_id, priority: int):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            rate = self.group_rate if isinstance(chat_id, str) or chat_id < 0 else self.chat_rate
+            bucket = PriorityBucket(rate, self.burst)
+        self.chat_buckets.set(chat_id, bucket)
+        await bucket.acquire(priority)
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            # Ответы на inline, callback и pre_checkout не считаются сообщениями в чат
+            return await make_request(bot, method)
+
+        edit_key = None
+        if isinstance(method, (EditMessageText, EditMessageReplyMarkup)) and method.message_id:
+            # Несколько правок одного сообщения в очереди: отправляем только последнюю
+            edit_key = (chat_id, method.message_id)
+            result = asyncio.get_running_loop().create_future()
+            self.latest_edits.set(edit_key, result)
 
+        try:
+            priority = self.priority_of(method)
+            if sends_message(method):
+                await self._chat_slot(chat_id, priority)
+            await self.global_bucket.acquire(priority)
+            latest = self.latest_edits.get(edit_key) if edit_key else None
+            if latest is not None and latest is not result:
+                # Пока ждали очереди, пришла более новая правка - эта уже не нужна
+                self.stats["coalesced"] += 1
+                response = await asyncio.shield(latest)
+                result.set_result(response)
+                return response
+            for attempt in range(self.max_retries + 1):
+                try:
+                    response = await make_request(bot, method)
+                    break
+                except TelegramRetryAfter as e:
+                    self.stats["retry_after"] += 1
+                    if attempt == self.max_retries:
+                        raise
+                    logger.warning(f"RetryAfter {e.retry_after} с для чата {chat_id}")
+                    await asyncio.sleep(e.retry_after)
+            if edit_key:
+                result.set_result(response)
+            return response
+        except BaseException as e:
+            if edit_key and not result.done():
+                if isinstance(e, asyncio.CancelledError):
+                    result.cancel()
+                else:
+                    result.set_exception(e)
+                    # Исключение уже пробрасывается здесь, отметим его как полученное
+                    result.exception()
+            raise
+
+outbound_scheduler = OutboundScheduler(API_GLOBAL_RATE, API_CHAT_RATE, API_GROUP_RATE, API_CHAT_BURST, API_MAX_RETRIES)
+bot.session.middleware(outbound_scheduler)
+if METRICS_ENABLED:
+    bot.session.middleware(ApiMetricsMiddleware())
+
+# ------------------- АНТИФЛУД -------------------
+def parse_rate(value: str) -> tuple:
+    limit, period = value.split("/")
+    return int(limit), float(period)
+
+class SlidingWindowLimiter:
+    """Счётчик по двум соседним окнам: вклад прошлого окна убывает линейно. На ключ - три числа."""
+
+    def __init__(self):
+        self.windows = {}  # (user_id, действие) -> [номер окна, события прошлого окна, события текущего]
+
+    def _entry(self, key, period: float, now: float) -> tuple:
+        index, offset = divmod(now, period)
+        index = int(index)
+        entry = self.windows.get(key)
+        if entry is None or entry[0] < index - 1:
+            entry = self.windows[key] = [index, 0, 0]
+        elif entry[0] == index - 1:
+            entry[0], entry[1], entry[2] = index, entry[2], 0
+        return entry, entry[1] * (1 - offset / period) + entry[2]
+
+    def allowed(self, key, limit: int, period: float, now: float) -> bool:
+        """Проверка без учёта события."""
+        return self._entry(key, period, now)[1] < limit
+
+    def hit(self, key, limit: int, period: float, now: float) -> bool:
+        entry, used = self._entry(key, period, now)
+        if used >= limit:
+            return False
+        entry[2] += 1
+        return True
+
+    def evict(self, now: float, period_of) -> int:
+        # Ключ без событий два окна подряд ничего не добавляет к оценке - его можно забыть
+        stale = [key for key, entry in self.windows.items() if entry[0] < int(now // period_of(key[1])) - 1]
+        for key in stale:
+            del self.windows[key]
+        return len(stale)
+
+    def __len__(self):
+        return len(self.windows)
+
+flood_rejected = Counter("platilka_antiflood_rejected_total", "Отброшенные антифлудом апдейты", ("action",))
+
+class AntiFloodMiddleware(BaseMiddleware):
+    """Outer middleware: флуд отбрасывается до фильтров и хэндлеров, то есть до БД и Bot API."""
+
+    def __init__(self, user_rate: tuple, action_rates: dict, failure_rates: dict):
+        self.user_rate = user_rate
+        self.action_rates = action_rates
+        self.failure_rates = failure_rates  # Такие действия считает хэндлер через record_failure, здесь только проверка
+        self.limiter = SlidingWindowLimiter()
+        self.warned = TTLCache(100000, 60)  # Кому уже ответили «слишком часто» - не отвечаем на каждое сообщение
+
+    def action_of(self, event, data: dict):
+        if isinstance(event, types.CallbackQuery):
+            payload = event.data or ""
+            return payload if payload in self.action_rates else payload.split("_", 1)[0]
+        if data.get("raw_state") == PaymentState.waiting_for_input.state:
+            return "code_input"
+        return None
+
+    def rate_of(self, action: str):
+        if action == "*":
+            return self.user_rate
+        return self.action_rates.get(action) or self.failure_rates.get(action)
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        # Оплата уже списана Telegram - её апдейт нельзя отбрасывать ни при каком флуде
+        if user is None or user.id == ADMIN_ID or getattr(event, "successful_payment", None):
+            return await handler(event, data)
+        now = time.monotonic()
+        action = self.action_of(event, data)
+        for counted in ("*", action):
+            rate = self.user_rate if counted == "*" else self.action_rates.get(counted)
+            if rate and not self.limiter.hit((user.id, counted), *rate, now):
+                flood_rejected.inc(counted)
+                await self.reject(event, (user.id, counted))
+                return None
+        rate = self.failure_rates.get(action)
+        if rate and not self.limiter.allowed((user.id, action), *rate, now):
+            flood_rejected.inc(action)
+            await self.reject(event, (user.id, action))
+            return None
+        return await handler(event, data)
+
+    def record_failure(self, user_id: int, action: str):
+        # Удачные попытки не считаем: продавец с верными кодами не упирается в лимит перебора
+        self.limiter.hit((user_id, action), *self.failure_rates[action], time.monotonic())
+
+    async def reject(self, event, key):
+        with suppress(TelegramBadRequest):
+            if isinstance(event, types.CallbackQuery):
+                # На нажатие отвечать нужно всегда, иначе кнопка будет крутиться
+                await event.answer("слишком часто, подожди немного")
+            elif self.warned.get(key) is None:
+                self.warned.set(key, True)
+                await event.answer("слишком много попыток, подожди минуту")
+
+    async def run_evictor(self, interval: float = 60):
+        while True:
+            await asyncio.sleep(interval)
+            self.limiter.evict(time.monotonic(), lambda action: self.rate_of(action)[1])
+
+antiflood = AntiFloodMiddleware(parse_rate(ANTIFLOOD_RATE), {
+    "withdraw_funds": parse_rate(ANTIFLOOD_WITHDRAW_RATE),
+    "open_profile": parse_rate(ANTIFLOOD_BUTTON_RATE),
+    "regenerate_code": parse_rate(ANTIFLOOD_BUTTON_RATE),
+    "make_payment": parse_rate(ANTIFLOOD_BUTTON_RATE),
+    "mywd": parse_rate(ANTIFLOOD_BUTTON_RATE),
+}, {
+    "code_input": parse_rate(ANTIFLOOD_CODE_RATE),
+})
+dp.message.outer_middleware(antiflood)
+dp.callback_query.outer_middleware(antiflood)
+
+# ------------------- ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ -------------------
 def get_user_link(user_id, first_name):
     safe_name = html.escape(first_name or "пользователь")
     return f"<a href='tg://user?id={user_id}'>{safe_name}</a>"
@@ -186,18 +2140,62 @@ def normalize_phone(phone_raw):
         digits = '7' + digits
     return f"+{digits}"
 
-async def main_menu_kb(user_id):
-    builder = InlineKeyboardBuilder()
-    builder.row(InlineKeyboardButton(text="📥 принять оплату", callback_data="receive_payment"))
-    builder.row(InlineKeyboardButton(text="💸 оплатить", callback_data="make_payment"))
-    builder.row(InlineKeyboardButton(text="👤 профиль", callback_data="open_profile"))
-    return builder.as_markup()
-
-def code_generation_kb():
-    builder = InlineKeyboardBuilder()
-    builder.row(InlineKeyboardButton(text="🔄 сгенерировать новый", callback_data="regenerate_code"))
-    builder.row(InlineKeyboardButton(text="🔙 назад", callback_data="back_to_menu"))
-    return builder.as_markup()
+# ------------------- ШАБЛОНЫ И КЛАВИАТУРЫ -------------------
+# Статичные клавиатуры собираются один раз при запуске; модели aiogram неизменяемые
+def static_kb(*rows):
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=text, callback_data=data) for text, data in row] for row in rows
+    ])
+
+MAIN_MENU_KB = static_kb(
+    [("📥 принять оплату", "receive_payment")],
+    [("💸 оплатить", "make_payment")],
+    [("👤 профиль", "open_profile")]
+)
+CODE_GENERATION_KB = static_kb([("🔄 сгенерировать новый", "regenerate_code")], [("🔙 назад", "back_to_menu")])
+BACK_TO_MENU_KB = static_kb([("🔙 назад", "back_to_menu")])
+TO_MENU_KB = static_kb([("в меню", "back_to_menu")])
+CANCEL_INVOICE_KB = static_kb([("🔙 назад", "cancel_invoice")])
+BACK_TO_PROFILE_KB = static_kb([("назад", "open_profile")])
+PAYMENT_METHOD_KB = static_kb([("сбп", "set_method_sbp"), ("карту", "set_method_card")], [("назад", "open_profile")])
+SBP_CONFIRM_KB = static_kb([("✅ подтвердить", "save_sbp"), ("✏️ изменить", "set_method_sbp")])
+PROFILE_EMPTY_KB = static_kb(
+    [("добавить реквизиты", "add_payment_details")],
+    [("📜 мои выводы", "mywd_0")],
+    [("назад", "back_to_menu")]
+)
+PROFILE_KB = static_kb(
+    [("✏️ изменить реквизиты", "add_payment_details")],
+    [("💎 вывести", "withdraw_funds"), ("📜 мои выводы", "mywd_0")],
+    [("назад", "back_to_menu")]
+)
+
+# Текстовые шаблоны: постоянная часть склеена заранее, в запросе только format
+STAR = "<tg-emoji emoji-id=\"5384159397263990339\">⭐</tg-emoji>"
+TPL_BALANCE = ("ваш баланс: {balance} " + STAR + " • {rub} ₽\n").format
+TEXT_NO_DETAILS = (
+    f"для вывода средств добавьте <tg-emoji emoji-id=\"{EMOJI_BANK_REQ}\">🏦</tg-emoji> введите сбп или "
+    f"<tg-emoji emoji-id=\"{EMOJI_CARD}\">🏦</tg-emoji> карту"
+)
+TPL_DETAILS_SBP = ("ваши реквизиты:\n<blockquote><tg-emoji emoji-id=\"" + EMOJI_BANK_REQ + "\">🏦</tg-emoji> сбп • {number} • {bank}</blockquote>").format
+TPL_DETAILS_CARD = ("ваши реквизиты:\n<blockquote><tg-emoji emoji-id=\"" + EMOJI_CARD + "\">🏦</tg-emoji> карта • {number}</blockquote>").format
+TPL_WITHDRAWAL_STATUS = ("<b>заявка принята</b>\n\nсумма: {amount} " + STAR + "\nстатус:\n<blockquote>{status}</blockquote>").format
+
+# Статус заявки: (текст пользователю, строка для админа)
+WITHDRAWAL_STATUS_TEXTS = {
+    "review": (
+        "на рассмотрении.. <tg-emoji emoji-id=\"5373153968769735192\">🧐</tg-emoji>",
+        "статус: <tg-emoji emoji-id=\"5424885441100782420\">👀</tg-emoji> на рассмотрении"
+    ),
+    "soon": (
+        "скоро отправим.. <tg-emoji emoji-id=\"5445284980978621387\">🚀</tg-emoji>",
+        "статус: <tg-emoji emoji-id=\"5445284980978621387\">🚀</tg-emoji> скоро будет"
+    ),
+    "done": (
+        "отправили <tg-emoji emoji-id=\"5472164874886846699\">✨</tg-emoji>",
+        "статус: <tg-emoji emoji-id=\"5206607081334906820\">✅</tg-emoji> выполнено"
+    ),
+}
 
 def confirm_invoice_kb(code, amount):
     builder = InlineKeyboardBuilder()
@@ -218,6 +2216,130 @@ def admin_withdrawal_kb(current_status, wd_id):
     return builder.as_markup() if current_status != 'done' else None
 
 # ------------------- ИНЛАЙН РЕЖИМ -------------------
+@functools.lru_cache(maxsize=10000)
+def inline_invoice_template(amount: int) -> InlineQueryResultArticle:
+    # Всё, что зависит только от суммы, собираем один раз; в запросе подставляются id и ссылка
+    text = f"оплатите счёт на {amount} stars <tg-emoji emoji-id=\"5384159397263990339\">⭐</tg-emoji>"
+    return InlineQueryResultArticle(
+        id="template",
+        title=f"отправить счёт на {amount} stars",
+        description="нажмите чтобы создать и отправить счёт пользователю",
+        input_message_content=InputTextMessageContent(message_text=text, parse_mode="HTML"),
+        thumb_url="https://files.catbox.moe/5uy724.png",
+        thumb_width=512,
+        thumb_height=512
+    )
+
+class InvoiceLinkPool:
+    """Заранее созданные ссылки на оплату по парам продавец-сумма; пополняется в фоне после каждой выдачи.
+
+    В одном процессе (STATE_BACKEND=memory) ссылки выдаются из памяти, а отметки о выдаче пишутся
+    в БД пачкой в фоне. Несколько воркеров делят одну таблицу, поэтому там ссылка забирается UPDATE'ом.
+    """
+
+    def __init__(self, size: int, flush_interval: float, in_memory: bool):
+        self.size = size
+        self.flush_interval = flush_interval
+        self.in_memory = in_memory
+        self.refilling = set()
+        self.missed = TTLCache(100000, 86400)  # Пары, для которых уже создавали ссылку на лету
+        self.ready = {}  # (продавец, сумма) -> deque[(payload, url)]: готовые ссылки этого процесса
+        self.issued = {}  # payload -> когда выдана; ещё не отмечено в БД
+        self.flushing = {}
+
+    @staticmethod
+    async def create(merchant_id: int, amount: int) -> tuple:
+        payload = f"direct_inv_{merchant_id}_{uuid.uuid4().hex[:12]}"
+        url = await bot.create_invoice_link(
+            title="оплата", description=f"перевод {amount} stars", payload=payload,
+            provider_token="", currency="XTR", prices=[LabeledPrice(label="услуга", amount=amount)]
+        )
+        return payload, url
+
+    async def _ready(self, key: tuple) -> deque:
+        ready = self.ready.get(key)
+        if ready is None:
+            # Первое обращение к паре после старта: забираем её пул из БД, уже выданные пропускаем
+            rows = await load_pooled_invoice_links(*key)
+            fresh = deque(row for row in rows if row[0] not in self.issued and row[0] not in self.flushing)
+            ready = self.ready.setdefault(key, fresh)
+        return ready
+
+    async def _claim(self, key: tuple):
+        if not self.in_memory:
+            return await claim_invoice_link(*key)
+        ready = await self._ready(key)
+        if not ready:
+            return None
+        payload, url = ready.popleft()
+        self.issued[payload] = int(time.time())
+        return url
+
+    async def take(self, merchant_id: int, amount: int):
+        # None - готовой ссылки нет: на лету не создаём, иначе ответ ждал бы createInvoiceLink и записи в БД,
+        # запрос получит ссылку через /start
+        key = (merchant_id, amount)
+        url = await self._claim(key)
+        if url is None:
+            invoice_link_misses.inc()
+            # Разовую сумму в пул не запасаем: пополняем, только когда она повторяется
+            if self.missed.get(key) is None:
+                self.missed.set(key, True)
+                return None
+        self.refill(merchant_id, amount)
+        return url
+
+    def refill(self, merchant_id: int, amount: int):
+        key = (merchant_id, amount)
+        if key not in self.refilling:
+            self.refilling.add(key)
+            start_background(self._refill(key))
+
+    async def _refill(self, key: tuple):
+        try:
+            if self.in_memory:
+                missing = self.size - len(await self._ready(key))
+            else:
+                missing = self.size - await count_pooled_invoice_links(*key)
+            with outbound_priority(PRIORITY_BULK):
+                links = [await self.create(*key) for _ in range(missing)]
+            if links:
+                await save_invoice_links(*key, links)
+                # В выдачу - только после записи: pre_checkout ищет ссылку в БД
+                if self.in_memory:
+                    (await self._ready(key)).extend(links)
+        except Exception as e:
+            logger.error(f"Ошибка пополнения пула ссылок {key}: {e}")
+        finally:
+            self.refilling.discard(key)
+
+    async def flush(self):
+        if not self.issued:
+            return
+        self.flushing, self.issued = self.issued, {}
+        try:
+            await mark_invoice_links_issued(self.flushing)
+        except Exception as e:
+            logger.error(f"Ошибка отметки выданных ссылок ({len(self.flushing)}): {e}")
+            self.issued.update(self.flushing)
+        except BaseException:
+            # Отмена посреди записи (остановка): пачку допишет финальный flush
+            self.issued.update(self.flushing)
+            raise
+        finally:
+            self.flushing = {}
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+invoice_link_pool = InvoiceLinkPool(INVOICE_LINK_POOL, INVOICE_LINK_FLUSH_INTERVAL, in_memory=STATE_BACKEND == "memory")
+invoice_link_misses = Counter("platilka_invoice_link_misses_total", "Инлайн-запросы, которым не хватило готовой ссылки на оплату")
+
+# Последний inline-запрос каждого пользователя: отвечаем только на него
+latest_inline_queries = {}
+
 @router.inline_query()
 async def inline_query_handler(query: types.InlineQuery):
     amount_str = query.query.strip()
@@ -229,33 +2351,36 @@ async def inline_query_handler(query: types.InlineQuery):
         return
     
     merchant_id = query.from_user.id
+    if INLINE_DEBOUNCE:
+        # Пока пользователь печатает «1», «10», «100», Telegram шлёт запрос на каждый символ
+        latest_inline_queries[merchant_id] = query.id
+        await asyncio.sleep(INLINE_DEBOUNCE)
+        if latest_inline_queries.get(merchant_id) != query.id:
+            return
+        del latest_inline_queries[merchant_id]
+
     unique_link_id = uuid.uuid4().hex[:12]
-    
-    text = f"оплатите счёт на {amount} stars <tg-emoji emoji-id=\"5384159397263990339\">⭐</tg-emoji>"
-    start_param = f"inline_pay_{amount}_{merchant_id}_{unique_link_id}"
-    
-    kb = InlineKeyboardBuilder()
-    kb.row(InlineKeyboardButton(text="оплатить", url=f"https://t.me/{BOT_USERNAME}?start={start_param}"))
-    
-    results = [
-        InlineQueryResultArticle(
-            id=str(uuid.uuid4()),
-            title=f"отправить счёт на {amount} stars",
-            description="нажмите чтобы создать и отправить счёт пользователю",
-            input_message_content=InputTextMessageContent(message_text=text, parse_mode="HTML"),
-            reply_markup=kb.as_markup(),
-            thumb_url="https://files.catbox.moe/5uy724.png",
-            thumb_width=512,
-            thumb_height=512
-        )
-    ]
-    await query.answer(results, cache_time=1)
+    url = None
+    if INLINE_DIRECT_LINKS:
+        # Ссылка createInvoiceLink открывает оплату прямо из чата: без /start, send_invoice и сообщений продавцу
+        try:
+            url = await invoice_link_pool.take(merchant_id, amount)
+        except Exception as e:
+            logger.error(f"Ошибка выдачи ссылки на оплату: {e}")
+    if url is None:
+        start_param = f"inline_pay_{amount}_{merchant_id}_{unique_link_id}"
+        url = f"https://t.me/{BOT_USERNAME}?start={start_param}"
+    kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="оплатить", url=url)]])
+    result = inline_invoice_template(amount).model_copy(update={"id": unique_link_id, "reply_markup": kb})
+    # Ответ персональный: в нём ссылка конкретного продавца. Кэш Telegram выключен: в ответе одноразовый id,
+    # и повторный запрос той же суммы из кэша дал бы второму покупателю уже оплаченную ссылку
+    await query.answer([result], cache_time=0, is_personal=True)
 
 # Обработка /start
 @router.message(Command("start"))
 async def cmd_start(message: types.Message, command: CommandObject, state: FSMContext):
     await state.clear()
-    await add_balance(message.from_user.id, 0)
+    await ensure_user(message.from_user.id)
     
     name = html.escape(message.from_user.first_name).lower()
     args = command.args
@@ -279,6 +2404,12 @@ async def cmd_start(message: types.Message, command: CommandObject, state: FSMCo
                 
                 payload = f"inline_inv_{merchant_id}_{link_uuid}"
                 prices = [LabeledPrice(label="услуга", amount=amount)]
+                # Счёт сохраняем до отправки: плательщик может нажать «оплатить», как только он придёт
+                await state_backend.save_invoice(payload, {
+                    "merchant_id": merchant_id,
+                    "payer_id": payer_id,
+                    "link_uuid": link_uuid
+                })
                 
                 try:
                     invoice_msg = await bot.send_invoice(
@@ -293,15 +2424,7 @@ async def cmd_start(message: types.Message, command: CommandObject, state: FSMCo
                     except Exception:
                         merchant_msg_id = None
                     
-                    merchant_transactions[payload] = {
-                        "merchant_id": merchant_id, 
-                        "merchant_msg_id": merchant_msg_id,
-                        "payer_id": payer_id,
-                        "invoice_msg_id": invoice_msg.message_id,
-                        "link_uuid": link_uuid,
-                        "original_chat_id": None,
-                        "original_msg_id": None
-                    }
+                    await state_backend.update_invoice(payload, merchant_msg_id=merchant_msg_id, invoice_msg_id=invoice_msg.message_id)
                 except Exception as e:
                     logger.error(f"Ошибка отправки инвойса: {e}")
                     await message.answer("ошибка отправки счёта")
@@ -311,7 +2434,7 @@ async def cmd_start(message: types.Message, command: CommandObject, state: FSMCo
     
     await message.answer(
         f"привет, {name} <tg-emoji emoji-id=\"5472055112702629499\">👋</tg-emoji>\nчто хочешь сделать?",
-        reply_markup=await main_menu_kb(message.from_user.id),
+        reply_markup=MAIN_MENU_KB,
         parse_mode="HTML"
     )
 
@@ -336,51 +2459,34 @@ async def show_profile(message: types.Message, user_id: int, is_edit=True):
         except IndexError:
             p_method, p_number, p_bank = None, None, None
 
-    rub_balance = int(balance * XTR_TO_RUB_RATE)
-    
-    text = f"ваш баланс: {balance} <tg-emoji emoji-id=\"5384159397263990339\">⭐</tg-emoji> • {rub_balance} ₽\n"
-    
-    kb = InlineKeyboardBuilder()
-    
+    text = TPL_BALANCE(balance=balance, rub=int(balance * XTR_TO_RUB_RATE))
     if not p_number:
-        text += f"для вывода средств добавьте <tg-emoji emoji-id=\"{EMOJI_BANK_REQ}\">🏦</tg-emoji> введите сбп или <tg-emoji emoji-id=\"{EMOJI_CARD}\">🏦</tg-emoji> карту"
-        kb.row(InlineKeyboardButton(text="добавить реквизиты", callback_data="add_payment_details"))
+        text += TEXT_NO_DETAILS
+        kb = PROFILE_EMPTY_KB
     else:
-        text += "ваши реквизиты:\n<blockquote>"
         if p_method == 'sbp':
-            text += f"<tg-emoji emoji-id=\"{EMOJI_BANK_REQ}\">🏦</tg-emoji> сбп • {p_number} • {p_bank}"
+            text += TPL_DETAILS_SBP(number=p_number, bank=p_bank)
         else:
-            text += f"<tg-emoji emoji-id=\"{EMOJI_CARD}\">🏦</tg-emoji> карта • {p_number}"
-        text += "</blockquote>"
-        
-        kb.row(InlineKeyboardButton(text="✏️ изменить реквизиты", callback_data="add_payment_details"))
-        kb.row(InlineKeyboardButton(text="💎 вывести", callback_data="withdraw_funds"))
-
-    kb.row(InlineKeyboardButton(text="назад", callback_data="back_to_menu"))
+            text += TPL_DETAILS_CARD(number=p_number)
+        kb = PROFILE_KB
     
     if is_edit:
-        await message.edit_text(text, parse_mode="HTML", reply_markup=kb.as_markup())
+        await message.edit_text(text, parse_mode="HTML", reply_markup=kb)
     else:
-        await message.answer(text, parse_mode="HTML", reply_markup=kb.as_markup())
+        await message.answer(text, parse_mode="HTML", reply_markup=kb)
 
 # --- Добавление реквизитов ---
 @router.callback_query(F.data == "add_payment_details")
 async def start_add_details(callback: types.CallbackQuery, state: FSMContext):
     await state.update_data(interface_msg_id=callback.message.message_id)
-    kb = InlineKeyboardBuilder()
-    kb.row(InlineKeyboardButton(text="сбп", callback_data="set_method_sbp"), 
-           InlineKeyboardButton(text="карту", callback_data="set_method_card"))
-    kb.row(InlineKeyboardButton(text="назад", callback_data="open_profile"))
-    await callback.message.edit_text("что хотите добавить?)", reply_markup=kb.as_markup())
+    await callback.message.edit_text("что хотите добавить?)", reply_markup=PAYMENT_METHOD_KB)
 
 # --- СБП FLOW ---
 @router.callback_query(F.data == "set_method_sbp")
 async def ask_sbp_phone(callback: types.CallbackQuery, state: FSMContext):
     await state.set_state(ProfileState.waiting_for_sbp_phone)
     text = f"<tg-emoji emoji-id=\"{EMOJI_PHONE}\">📱</tg-emoji> введите номер телефона, который привязан к вашему банку"
-    kb = InlineKeyboardBuilder()
-    kb.row(InlineKeyboardButton(text="назад", callback_data="open_profile"))
-    await callback.message.edit_text(text, parse_mode="HTML", reply_markup=kb.as_markup())
+    await callback.message.edit_text(text, parse_mode="HTML", reply_markup=BACK_TO_PROFILE_KB)
 
 @router.message(ProfileState.waiting_for_sbp_phone)
 async def process_sbp_phone(message: types.Message, state: FSMContext):
@@ -396,11 +2502,8 @@ async def process_sbp_phone(message: types.Message, state: FSMContext):
     msg_id = data.get("interface_msg_id")
     
     text = f"теперь отправьте название вашего банка, например <tg-emoji emoji-id=\"{EMOJI_T_BANK}\">🏦</tg-emoji> т-банк"
-    kb = InlineKeyboardBuilder()
-    kb.row(InlineKeyboardButton(text="назад", callback_data="open_profile"))
-    
     if msg_id:
-        await bot.edit_message_text(text=text, chat_id=message.chat.id, message_id=msg_id, parse_mode="HTML", reply_markup=kb.as_markup())
+        await bot.edit_message_text(text=text, chat_id=message.chat.id, message_id=msg_id, parse_mode="HTML", reply_markup=BACK_TO_PROFILE_KB)
 
 @router.message(ProfileState.waiting_for_sbp_bank)
 async def process_sbp_bank(message: types.Message, state: FSMContext):
@@ -416,12 +2519,8 @@ async def process_sbp_bank(message: types.Message, state: FSMContext):
     await state.set_state(ProfileState.confirm_sbp)
     text = (f"ваш номер: {phone}\nваш банк: {bank_name}\nвсё верно?)")
     
-    kb = InlineKeyboardBuilder()
-    kb.row(InlineKeyboardButton(text="✅ подтвердить", callback_data="save_sbp"),
-           InlineKeyboardButton(text="✏️ изменить", callback_data="set_method_sbp"))
-    
     if msg_id:
-        await bot.edit_message_text(text=text, chat_id=message.chat.id, message_id=msg_id, parse_mode="HTML", reply_markup=kb.as_markup())
+        await bot.edit_message_text(text=text, chat_id=message.chat.id, message_id=msg_id, parse_mode="HTML", reply_markup=SBP_CONFIRM_KB)
 
 @router.callback_query(F.data == "save_sbp")
 async def save_sbp_data(callback: types.CallbackQuery, state: FSMContext):
@@ -437,9 +2536,7 @@ async def save_sbp_data(callback: types.CallbackQuery, state: FSMContext):
 async def ask_card_number(callback: types.CallbackQuery, state: FSMContext):
     await state.set_state(ProfileState.waiting_for_card)
     text = "введите номер карты"
-    kb = InlineKeyboardBuilder()
-    kb.row(InlineKeyboardButton(text="назад", callback_data="open_profile"))
-    await callback.message.edit_text(text, parse_mode="HTML", reply_markup=kb.as_markup())
+    await callback.message.edit_text(text, parse_mode="HTML", reply_markup=BACK_TO_PROFILE_KB)
 
 @router.message(ProfileState.waiting_for_card)
 async def process_card(message: types.Message, state: FSMContext):
@@ -457,16 +2554,8 @@ async def process_card(message: types.Message, state: FSMContext):
     if msg_id:
         user_data = await get_user_data(message.from_user.id)
         balance = user_data[0]
-        rub_balance = int(balance * XTR_TO_RUB_RATE)
-        text = (
-            f"ваш баланс: {balance} <tg-emoji emoji-id=\"5384159397263990339\">⭐</tg-emoji> • {rub_balance} ₽\n"
-            f"ваши реквизиты:\n<blockquote><tg-emoji emoji-id=\"{EMOJI_CARD}\">🏦</tg-emoji> карта • {card_num}</blockquote>"
-        )
-        kb = InlineKeyboardBuilder()
-        kb.row(InlineKeyboardButton(text="✏️ изменить реквизиты", callback_data="add_payment_details"))
-        kb.row(InlineKeyboardButton(text="💎 вывести", callback_data="withdraw_funds"))
-        kb.row(InlineKeyboardButton(text="назад", callback_data="back_to_menu"))
-        await bot.edit_message_text(text=text, chat_id=message.chat.id, message_id=msg_id, parse_mode="HTML", reply_markup=kb.as_markup())
+        text = TPL_BALANCE(balance=balance, rub=int(balance * XTR_TO_RUB_RATE)) + TPL_DETAILS_CARD(number=card_num)
+        await bot.edit_message_text(text=text, chat_id=message.chat.id, message_id=msg_id, parse_mode="HTML", reply_markup=PROFILE_KB)
 
 # ------------------- ВЫВОД СРЕДСТВ -------------------
 @router.callback_query(F.data == "withdraw_funds")
@@ -495,43 +2584,62 @@ async def withdraw_handler(callback: types.CallbackQuery):
         await callback.answer("Заполните реквизиты!", show_alert=True)
         return
 
-    await callback.message.edit_text("⏳ создаем заявку...", reply_markup=None)
-    amount_withdrawn = await reset_balance_safe(user_id)
-    if amount_withdrawn <= 0:
-        await callback.message.edit_text("ошибка баланса", reply_markup=await main_menu_kb(user_id))
+    # Сообщение с профилем становится квитанцией заявки, его id и запоминаем
+    created = await create_withdrawal(user_id, details_str, callback.message.message_id, callback.from_user.first_name)
+    if created is None:
+        await callback.message.edit_text("ошибка баланса", reply_markup=MAIN_MENU_KB)
         return
-        
-    final_rub = int(amount_withdrawn * XTR_TO_RUB_RATE)
-    initial_status = "на рассмотрении.. <tg-emoji emoji-id=\"5373153968769735192\">🧐</tg-emoji>"
+
+    wd_id, amount_withdrawn, final_rub = created
+    initial_status = WITHDRAWAL_STATUS_TEXTS["review"][0]
     text = (
         "<b>заявка принята</b>\n\n"
-        f"сумма: {amount_withdrawn} <tg-emoji emoji-id=\"5384159397263990339\">⭐</tg-emoji>\n"
+        f"сумма: {amount_withdrawn} {STAR}\n"
         f"к получению: {final_rub} ₽\n"
         f"реквизиты: {details_str}\n"
         f"статус:\n<blockquote>{initial_status}</blockquote>"
     )
-    kb = InlineKeyboardBuilder().add(InlineKeyboardButton(text="🔙 назад", callback_data="back_to_menu")).as_markup()
-    msg = await callback.message.edit_text(text, parse_mode="HTML", reply_markup=kb)
+    await callback.message.edit_text(text, parse_mode="HTML", reply_markup=BACK_TO_MENU_KB)
 
-    wd_id = await create_withdrawal(user_id, amount_withdrawn, final_rub, details_str, msg.message_id)
+# --- История выводов ---
+HISTORY_STATUS_TITLES = {"wait": "принята", "review": "на рассмотрении", "soon": "скоро отправим", "done": "отправили"}
 
-    try:
-        user_link = get_user_link(user_id, callback.from_user.first_name)
-        admin_text = (
-            f"<tg-emoji emoji-id=\"5206222720416643915\">🔔</tg-emoji> <b>новая заявка</b> #{wd_id}\n\n"
-            f"от: {user_link}\n"
-            f"id: <code>{user_id}</code>\n"
-            f"сумма: <b>{amount_withdrawn} <tg-emoji emoji-id=\"5384159397263990339\">⭐</tg-emoji></b> (~{final_rub} ₽)\n"
-            f"реквизиты: <code>{details_str}</code>"
-        )
-        await bot.send_message(
-            chat_id=ADMIN_ID, 
-            text=admin_text, 
-            parse_mode="HTML",
-            reply_markup=admin_withdrawal_kb('wait', wd_id)
-        )
-    except Exception as e:
-        logger.error(f"Ошибка отправки админу: {e}")
+@router.callback_query(F.data.startswith("mywd_"))
+async def withdrawal_history_handler(callback: types.CallbackQuery):
+    before_id = int(callback.data.split("_")[1])
+    # Берём на одну строку больше, чтобы понять, есть ли страница дальше
+    rows = [row async for row in iter_user_withdrawals(callback.from_user.id, before_id, HISTORY_PAGE + 1)]
+    has_more = len(rows) > HISTORY_PAGE
+    rows = rows[:HISTORY_PAGE]
+
+    lines = ["<b>мои выводы</b>"]
+    for wd_id, amount, rub_amount, status in rows:
+        lines.append(f"#{wd_id} • {amount} {STAR} • {rub_amount} ₽ • {HISTORY_STATUS_TITLES.get(status, status)}")
+    if not rows:
+        lines.append("выводов пока не было")
+
+    builder = InlineKeyboardBuilder()
+    if has_more:
+        builder.row(InlineKeyboardButton(text="⏭ раньше", callback_data=f"mywd_{rows[-1][0]}"))
+    builder.row(InlineKeyboardButton(text="назад", callback_data="open_profile"))
+    await callback.message.edit_text("\n".join(lines), parse_mode="HTML", reply_markup=builder.as_markup())
+
+# --- Статистика продаж ---
+SALES_PERIOD_TITLES = (("24h", "за 24 часа"), ("today", "сегодня (UTC)"), ("7d", "за 7 дней"), ("30d", "за 30 дней"), ("total", "всего"))
+
+@router.message(Command("stats"))
+async def sales_stats_handler(message: types.Message, command: CommandObject):
+    merchant_id = message.from_user.id
+    # Админ может посмотреть любого продавца: /stats <user_id>
+    if command.args and message.from_user.id == ADMIN_ID and command.args.strip().isdigit():
+        merchant_id = int(command.args.strip())
+
+    stats = await get_sales_stats(merchant_id)
+    lines = ["<b>продажи</b>"]
+    for key, title in SALES_PERIOD_TITLES:
+        sales, stars = stats[key]
+        lines.append(f"{title}: {sales} • {stars} {STAR} (~{int(stars * XTR_TO_RUB_RATE)} ₽)")
+    await message.answer("\n".join(lines), parse_mode="HTML")
 
 # ------------------- ЛОГИКА АДМИНА -------------------
 @router.callback_query(F.data.startswith("setstat_"))
@@ -548,35 +2656,11 @@ async def change_status_handler(callback: types.CallbackQuery):
     user_id, amount, user_msg_id, current_status = wd_data
     
     new_status = action
-    status_text_user = ""
-    status_emoji_admin = ""
-    
-    if action == "review":
-        status_text_user = "на рассмотрении.. <tg-emoji emoji-id=\"5373153968769735192\">🧐</tg-emoji>"
-        status_emoji_admin = "статус: <tg-emoji emoji-id=\"5424885441100782420\">👀</tg-emoji> на рассмотрении"
-    elif action == "soon":
-        status_text_user = "скоро отправим.. <tg-emoji emoji-id=\"5445284980978621387\">🚀</tg-emoji>"
-        status_emoji_admin = "статус: <tg-emoji emoji-id=\"5445284980978621387\">🚀</tg-emoji> скоро будет"
-    elif action == "done":
-        status_text_user = "отправили <tg-emoji emoji-id=\"5472164874886846699\">✨</tg-emoji>"
-        status_emoji_admin = "статус: <tg-emoji emoji-id=\"5206607081334906820\">✅</tg-emoji> выполнено"
+    _, status_emoji_admin = WITHDRAWAL_STATUS_TEXTS.get(action, ("", ""))
     
+    # Пользователь получит новый статус через outbox
     await update_withdrawal_status(wd_id, new_status)
-    
-    user_text = (
-        "<b>заявка принята</b>\n\n"
-        f"сумма: {amount} <tg-emoji emoji-id=\"5384159397263990339\">⭐</tg-emoji>\n"
-        f"статус:\n<blockquote>{status_text_user}</blockquote>"
-    )
-    try:
-        back_btn = InlineKeyboardBuilder().add(InlineKeyboardButton(text="🔙 назад", callback_data="back_to_menu")).as_markup()
-        await bot.edit_message_text(
-            text=user_text, chat_id=user_id, message_id=user_msg_id,
-            parse_mode="HTML", reply_markup=back_btn
-        )
-    except Exception as e:
-        logger.error(f"Ошибка редактирования сообщения пользователя: {e}")
-        
+
     try:
         updated_admin_text = (f"{callback.message.text}\n\n<b>{status_emoji_admin}</b>")
         new_kb = admin_withdrawal_kb(new_status, wd_id) if new_status != 'done' else None
@@ -584,15 +2668,247 @@ async def change_status_handler(callback: types.CallbackQuery):
     except Exception as e:
         logger.error(f"Ошибка редактирования сообщения админа: {e}")
 
+# Очередь заявок: следующий статус и подписи
+NEXT_STATUS = {"wait": "review", "review": "soon", "soon": "done"}
+STATUS_TITLES = {"wait": "новые", "review": "на рассмотрении", "soon": "скоро отправим", "done": "выполнены"}
+
+async def render_withdrawal_queue(status: str, after_id: int = 0):
+    rows = await list_withdrawals(status, after_id)
+    lines = [f"<b>заявки: {STATUS_TITLES[status]}</b>"]
+    for wd_id, user_id, amount, rub_amount, details in rows:
+        lines.append(f"#{wd_id} • <code>{user_id}</code> • {amount} {STAR} (~{rub_amount} ₽) • {html.escape(details or '')}")
+    if not rows:
+        lines.append("пусто")
+
+    builder = InlineKeyboardBuilder()
+    builder.row(*(
+        InlineKeyboardButton(text=("• " if s == status else "") + s, callback_data=f"wdq_{s}_0")
+        for s in NEXT_STATUS
+    ))
+    if rows and status in NEXT_STATUS:
+        next_status = NEXT_STATUS[status]
+        builder.row(InlineKeyboardButton(
+            text=f"всю страницу → {STATUS_TITLES[next_status]}",
+            callback_data=f"wdbulk_{status}_{rows[0][0]}_{rows[-1][0]}"
+        ))
+    if len(rows) == ADMIN_QUEUE_PAGE:
+        builder.row(InlineKeyboardButton(text="дальше ⏭", callback_data=f"wdq_{status}_{rows[-1][0]}"))
+    return "\n".join(lines), builder.as_markup()
+
+@router.message(Command("queue"), F.from_user.id == ADMIN_ID)
+async def withdrawal_queue_handler(message: types.Message, command: CommandObject):
+    status = (command.args or "wait").strip()
+    if status not in STATUS_TITLES:
+        await message.answer(f"статусы: {', '.join(STATUS_TITLES)}")
+        return
+    text, kb = await render_withdrawal_queue(status)
+    await message.answer(text, parse_mode="HTML", reply_markup=kb)
+
+@router.callback_query(F.data.startswith("wdq_"), F.from_user.id == ADMIN_ID)
+async def withdrawal_queue_page(callback: types.CallbackQuery):
+    _, status, after_id = callback.data.split("_")
+    text, kb = await render_withdrawal_queue(status, int(after_id))
+    await callback.message.edit_text(text, parse_mode="HTML", reply_markup=kb)
+
+@router.callback_query(F.data.startswith("wdbulk_"), F.from_user.id == ADMIN_ID)
+async def withdrawal_bulk_handler(callback: types.CallbackQuery):
+    _, status, first_id, last_id = callback.data.split("_")
+    next_status = NEXT_STATUS[status]
+    # Одна транзакция на всю страницу; уведомления уходят фоном с ограничением скорости
+    updated = await bulk_update_withdrawal_status(status, next_status, int(first_id), int(last_id))
+    await callback.answer(f"обновлено заявок: {len(updated)}")
+    text, kb = await render_withdrawal_queue(status)
+    await callback.message.edit_text(text, parse_mode="HTML", reply_markup=kb)
+
+# --- Outbox: доставка уведомлений после коммита ---
+outbox_stats = {"sent": 0, "retried": 0, "dropped": 0, "superseded": 0}
+
+async def deliver_admin_withdrawal(data: dict):
+    user_link = get_user_link(data["user_id"], data["first_name"])
+    admin_text = (
+        f"<tg-emoji emoji-id=\"5206222720416643915\">🔔</tg-emoji> <b>новая заявка</b> #{data['wd_id']}\n\n"
+        f"от: {user_link}\n"
+        f"id: <code>{data['user_id']}</code>\n"
+        f"сумма: <b>{data['amount']} {STAR}</b> (~{data['rub_amount']} ₽)\n"
+        f"реквизиты: <code>{data['details']}</code>"
+    )
+    await bot.send_message(
+        chat_id=ADMIN_ID,
+        text=admin_text,
+        parse_mode="HTML",
+        reply_markup=admin_withdrawal_kb('wait', data["wd_id"])
+    )
+
+async def deliver_withdrawal_status(data: dict):
+    # Повторы идут по своему расписанию: отставшее уведомление не должно затереть более новый статус
+    if "wd_id" in data:
+        current = await get_withdrawal(data["wd_id"])
+        if current is None or current[3] != data["status"]:
+            return False
+    bulk = data.get("bulk", False)
+    with outbound_priority(PRIORITY_BULK if bulk else PRIORITY_NORMAL):
+        await bot.edit_message_text(
+            text=TPL_WITHDRAWAL_STATUS(amount=data["amount"], status=WITHDRAWAL_STATUS_TEXTS[data["status"]][0]),
+            chat_id=data["user_id"], message_id=data["message_id"],
+            parse_mode="HTML", reply_markup=BACK_TO_MENU_KB
+        )
+    if bulk:
+        await asyncio.sleep(1 / NOTIFY_RATE)
+
+OUTBOX_HANDLERS = {
+    "admin_withdrawal": deliver_admin_withdrawal,
+    "withdrawal_status": deliver_withdrawal_status,
+}
+
+async def outbox_dispatcher(poll: float = OUTBOX_POLL):
+    while True:
+        # Сбрасываем до выборки: сигнал, пришедший во время доставки, не потеряется
+        outbox_wakeup.clear()
+        try:
+            rows = await claim_outbox()
+        except Exception as e:
+            logger.error(f"Ошибка чтения outbox: {e}")
+            rows = []
+        if not rows:
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(outbox_wakeup.wait(), poll)
+            continue
+
+        done, retries = [], []
+        for outbox_id, kind, payload, attempts in rows:
+            try:
+                delivered = await OUTBOX_HANDLERS[kind](json.loads(payload))
+                outbox_stats["superseded" if delivered is False else "sent"] += 1
+                done.append(outbox_id)
+            except (TelegramBadRequest, TelegramForbiddenError) as e:
+                # Сообщение удалено, бот заблокирован и т.п. - повтор не поможет
+                logger.error(f"Уведомление {kind} #{outbox_id} не доставлено: {e}")
+                outbox_stats["dropped"] += 1
+                done.append(outbox_id)
+            except Exception as e:
+                if attempts >= OUTBOX_MAX_ATTEMPTS:
+                    logger.error(f"Уведомление {kind} #{outbox_id} отброшено после {attempts} попыток: {e}")
+                    outbox_stats["dropped"] += 1
+                    done.append(outbox_id)
+                else:
+                    logger.warning(f"Уведомление {kind} #{outbox_id} будет повторено: {e}")
+                    outbox_stats["retried"] += 1
+                    retries.append((int(time.time()) + min(2 ** attempts, 600), outbox_id))
+        try:
+            await settle_outbox(done, retries)
+        except Exception as e:
+            # Не отмеченные сообщения вернутся после OUTBOX_LEASE
+            logger.error(f"Ошибка записи outbox: {e}")
+
+# --- Рассылка ---
+BROADCAST_STATUS_TITLES = {"running": "идёт", "done": "завершена", "cancelled": "остановлена"}
+
+def broadcast_status_text(bc_id: int, status: str, sent: int, blocked: int, failed: int, rate: float, elapsed: float) -> str:
+    return (
+        f"<b>рассылка #{bc_id}: {BROADCAST_STATUS_TITLES[status]}</b>\n\n"
+        f"доставлено: {sent}\n"
+        f"заблокировали бота: {blocked}\n"
+        f"ошибок: {failed}\n"
+        f"скорость: {rate:.1f}/с, прошло {int(elapsed)} с"
+    )
+
+async def run_broadcast(bc_id: int):
+    source_chat_id, source_message_id, status_message_id, status, last_user_id, sent, blocked, failed = await get_broadcast(bc_id)
+    queue = asyncio.Queue()
+    page = {}
+
+    async def worker():
+        while True:
+            user_id = await queue.get()
+            try:
+                # Самый низкий приоритет: оплаты и ответы пользователям идут вперёд рассылки
+                with outbound_priority(PRIORITY_BULK):
+                    await bot.copy_message(chat_id=user_id, from_chat_id=source_chat_id, message_id=source_message_id)
+                page["sent"] += 1
+            except TelegramForbiddenError:
+                page["blocked"].append(user_id)
+            except Exception as e:
+                logger.warning(f"Рассылка #{bc_id}: не доставлено {user_id}: {e}")
+                page["failed"] += 1
+            finally:
+                queue.task_done()
+
+    async def report(status: str):
+        elapsed = time.monotonic() - started
+        text = broadcast_status_text(bc_id, status, sent, blocked, failed, delivered_now / elapsed if elapsed else 0.0, elapsed)
+        kb = None
+        if status == "running":
+            kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="⏹ остановить", callback_data=f"bcstop_{bc_id}")]])
+        with outbound_priority(PRIORITY_COSMETIC), suppress(TelegramBadRequest):
+            await bot.edit_message_text(text, chat_id=source_chat_id, message_id=status_message_id, parse_mode="HTML", reply_markup=kb)
+
+    started = last_report = time.monotonic()
+    delivered_now = 0
+    workers = [asyncio.create_task(worker()) for _ in range(BROADCAST_WORKERS)]
+    try:
+        async for recipients in iter_broadcast_recipients(last_user_id):
+            page.update(sent=0, blocked=[], failed=0)
+            for user_id in recipients:
+                queue.put_nowait(user_id)
+            await queue.join()
+
+            last_user_id = recipients[-1]
+            sent += page["sent"]
+            blocked += len(page["blocked"])
+            failed += page["failed"]
+            delivered_now += page["sent"]
+            status = await checkpoint_broadcast(bc_id, last_user_id, page["sent"], page["blocked"], page["failed"])
+            if status != "running":
+                break
+            if time.monotonic() - last_report >= BROADCAST_REPORT_INTERVAL:
+                last_report = time.monotonic()
+                await report(status)
+        else:
+            status = await checkpoint_broadcast(bc_id, last_user_id, 0, [], 0, finished=True)
+    finally:
+        for task in workers:
+            task.cancel()
+    await report(status)
+
+async def resume_broadcasts():
+    # Один процесс после рестарта забирает всё сразу; несколько воркеров - только брошенные
+    for bc_id in await claim_broadcasts(0 if STATE_BACKEND == "memory" else BROADCAST_LEASE):
+        logger.info(f"Продолжаем рассылку #{bc_id}")
+        start_background(run_broadcast(bc_id))
+
+@router.message(Command("broadcast"), F.from_user.id == ADMIN_ID)
+async def broadcast_handler(message: types.Message):
+    source = message.reply_to_message
+    if source is None:
+        await message.answer("ответь командой /broadcast на сообщение, которое нужно разослать")
+        return
+    status_msg = await message.answer("рассылка запускается..")
+    bc_id = await create_broadcast(message.chat.id, source.message_id, status_msg.message_id)
+    start_background(run_broadcast(bc_id))
+
+@router.callback_query(F.data.startswith("bcstop_"), F.from_user.id == ADMIN_ID)
+async def broadcast_stop_handler(callback: types.CallbackQuery):
+    await cancel_broadcast(int(callback.data.split("_")[1]))
+    await callback.answer("рассылка остановится после текущей пачки")
+
+@router.message(Command("cache"), F.from_user.id == ADMIN_ID)
+async def cache_stats_handler(message: types.Message):
+    stats = user_cache.stats()
+    await message.answer(
+        f"кэш профилей: {stats['size']} записей\n"
+        f"попадания: {stats['hits']} ({stats['hit_rate']:.1%}), промахи: {stats['misses']}, "
+        f"склеено промахов: {stats['coalesced']}"
+    )
+
 # ------------------- ОБЫЧНЫЕ ХЭНДЛЕРЫ -------------------
 @router.callback_query(F.data == "back_to_menu")
 async def back_handler(callback: types.CallbackQuery, state: FSMContext):
     data = await state.get_data()
     code = data.get("current_code")
-    if code and code in active_sessions:
-        del active_sessions[code]
+    if code:
+        await state_backend.release_code(code, callback.from_user.id)
     await state.clear()
-    await callback.message.edit_text("главное меню:", reply_markup=await main_menu_kb(callback.from_user.id))
+    await callback.message.edit_text("главное меню:", reply_markup=MAIN_MENU_KB)
 
 @router.callback_query(F.data == "make_payment")
 async def start_payment_mode(callback: types.CallbackQuery, state: FSMContext):
@@ -602,21 +2918,20 @@ async def start_payment_mode(callback: types.CallbackQuery, state: FSMContext):
 async def regenerate_code_handler(callback: types.CallbackQuery, state: FSMContext):
     data = await state.get_data()
     old_code = data.get("current_code")
-    if old_code and old_code in active_sessions:
-        del active_sessions[old_code]
+    if old_code:
+        await state_backend.release_code(old_code, callback.from_user.id)
     await generate_and_show_code(callback.message, callback.from_user.id, state, is_edit=True)
 
 async def generate_and_show_code(message: types.Message, user_id: int, state: FSMContext, is_edit=True):
-    new_code = generate_code()
+    new_code = await state_backend.allocate_code({"user_id": user_id, "active": True, "message_id": None})
     await state.update_data(current_code=new_code)
     text = (f"твой код: <code>{new_code}</code>\n\nскажи этот код продавцу\nесли код не работает, нажми кнопку ниже")
-    active_sessions[new_code] = {"user_id": user_id, "active": True, "message_id": None}
-    kb = code_generation_kb()
+    kb = CODE_GENERATION_KB
     if is_edit:
         msg = await message.edit_text(text, parse_mode="HTML", reply_markup=kb)
     else:
         msg = await message.answer(text, parse_mode="HTML", reply_markup=kb)
-    active_sessions[new_code]["message_id"] = msg.message_id
+    await state_backend.update_session(new_code, message_id=msg.message_id)
 
 @router.callback_query(F.data == "receive_payment")
 async def receive_payment_start(callback: types.CallbackQuery, state: FSMContext):
@@ -625,7 +2940,7 @@ async def receive_payment_start(callback: types.CallbackQuery, state: FSMContext
     await callback.message.edit_text(
         "введи <b>код клиента</b> и <b>сумму</b> через пробел\nнапример: <code>1234 50</code>",
         parse_mode="HTML",
-        reply_markup=InlineKeyboardBuilder().add(InlineKeyboardButton(text="🔙 назад", callback_data="cancel_invoice")).as_markup()
+        reply_markup=CANCEL_INVOICE_KB
     )
 
 @router.message(PaymentState.waiting_for_input)
@@ -644,25 +2959,26 @@ async def process_merchant_input(message: types.Message, state: FSMContext):
         if amount <= 0 or amount > 10000:
             raise ValueError("invalid_amount")
         
-        session = active_sessions.get(code)
+        session = await state_backend.get_session(code)
         if not session or not session["active"]:
+            antiflood.record_failure(message.from_user.id, "code_input")
             await bot.edit_message_text(
                 chat_id=message.chat.id, message_id=interface_msg_id,
                 text="<tg-emoji emoji-id=\"5210952531676504517\">❌</tg-emoji> код не найден или устарел\nпопробуй снова:",
-                reply_markup=InlineKeyboardBuilder().add(InlineKeyboardButton(text="🔙 назад", callback_data="cancel_invoice")).as_markup(),
+                reply_markup=CANCEL_INVOICE_KB,
                 parse_mode="HTML"
             )
             return
 
         payer_id = session["user_id"]
         try:
-            payer_info = await bot.get_chat(payer_id)
-            p_name = payer_info.first_name if payer_info.first_name else "клиент"
+            # Плательщик сам запросил код, так что его имя уже в кэше - без get_chat
+            p_name = await user_names.get(payer_id) or "клиент"
             payer_link = get_user_link(payer_id, p_name)
         except Exception:
             payer_link = "клиенту"
 
-        confirm_text = f"выставить счёт {payer_link} на <b>{amount} <tg-emoji emoji-id=\"5384159397263990339\">⭐</tg-emoji></b>?"
+        confirm_text = f"выставить счёт {payer_link} на <b>{amount} {STAR}</b>?"
         await bot.edit_message_text(
             chat_id=message.chat.id, message_id=interface_msg_id,
             text=confirm_text, parse_mode="HTML",
@@ -673,7 +2989,7 @@ async def process_merchant_input(message: types.Message, state: FSMContext):
         await bot.edit_message_text(
             chat_id=message.chat.id, message_id=interface_msg_id,
             text=error_text, parse_mode="HTML",
-            reply_markup=InlineKeyboardBuilder().add(InlineKeyboardButton(text="🔙 назад", callback_data="cancel_invoice")).as_markup()
+            reply_markup=CANCEL_INVOICE_KB
         )
 
 @router.callback_query(F.data.startswith("confirm_"))
@@ -683,9 +2999,9 @@ async def send_invoice_to_user(callback: types.CallbackQuery):
     
     await callback.message.edit_text("<tg-emoji emoji-id=\"6113789201717660877\">⏳</tg-emoji> счёт отправлен, ждем оплату..", reply_markup=None, parse_mode="HTML")
     
-    session = active_sessions.get(code)
+    session = await state_backend.get_session(code)
     if session:
-        active_sessions[code]["active"] = False
+        await state_backend.update_session(code, active=False)
         try:
             await bot.edit_message_text(
                 chat_id=session["user_id"], message_id=session["message_id"],
@@ -697,30 +3013,46 @@ async def send_invoice_to_user(callback: types.CallbackQuery):
 
         payload = f"inv_{callback.from_user.id}_{uuid.uuid4().hex}"
         prices = [LabeledPrice(label="услуга", amount=amount)]
-        
-        invoice_msg = await bot.send_invoice(
-            chat_id=session["user_id"], title="оплата", description=f"перевод {amount} stars",
-            payload=payload, provider_token="", currency="XTR", prices=prices, start_parameter="pay"
-        )
-        merchant_transactions[payload] = {
+        # Счёт сохраняем до отправки: плательщик может нажать «оплатить», как только он придёт
+        await state_backend.save_invoice(payload, {
             "merchant_id": callback.from_user.id, 
             "merchant_msg_id": callback.message.message_id,
             "payer_id": session["user_id"],
-            "payer_prompt_msg_id": session["message_id"],
-            "invoice_msg_id": invoice_msg.message_id
-        }
+            "payer_prompt_msg_id": session["message_id"]
+        })
+        
+        try:
+            invoice_msg = await bot.send_invoice(
+                chat_id=session["user_id"], title="оплата", description=f"перевод {amount} stars",
+                payload=payload, provider_token="", currency="XTR", prices=prices, start_parameter="pay"
+            )
+        except Exception:
+            await state_backend.delete_invoice(payload)
+            raise
+        await state_backend.update_invoice(payload, invoice_msg_id=invoice_msg.message_id)
     else:
-        await callback.message.edit_text("<tg-emoji emoji-id=\"5210952531676504517\">❌</tg-emoji> ошибка: клиент ушел или код истек", reply_markup=await main_menu_kb(callback.from_user.id), parse_mode="HTML")
+        await callback.message.edit_text("<tg-emoji emoji-id=\"5210952531676504517\">❌</tg-emoji> ошибка: клиент ушел или код истек", reply_markup=MAIN_MENU_KB, parse_mode="HTML")
 
 @router.callback_query(F.data == "cancel_invoice")
 async def cancel_invoice(callback: types.CallbackQuery, state: FSMContext):
     await state.clear()
-    await callback.message.edit_text("отменено", reply_markup=await main_menu_kb(callback.from_user.id))
+    await callback.message.edit_text("отменено", reply_markup=MAIN_MENU_KB)
 
 # ------------------- ФИНАЛ ОПЛАТЫ -------------------
 @router.pre_checkout_query()
 async def pre_checkout(query: PreCheckoutQuery):
     payload = query.invoice_payload
+    if payload.startswith("direct_inv_"):
+        link = await get_invoice_link(payload)
+        if link is None or link["amount"] != query.total_amount:
+            await query.answer(ok=False, error_message="Счёт уже оплачен или устарел")
+        elif link["merchant_id"] == query.from_user.id:
+            await query.answer(ok=False, error_message="Нельзя оплатить собственный счёт")
+        elif not await state_backend.reserve_invoice(payload, query.from_user.id):
+            await query.answer(ok=False, error_message="Этот счёт уже оплачивает другой пользователь")
+        else:
+            await query.answer(ok=True)
+        return
     if "inline_inv_" in payload:
         parts = payload.split("_")
         if len(parts) >= 4:
@@ -728,7 +3060,7 @@ async def pre_checkout(query: PreCheckoutQuery):
             if await is_link_used(link_uuid):
                  await query.answer(ok=False, error_message="Ссылка уже использована")
                  return
-    if payload not in merchant_transactions:
+    if await state_backend.get_invoice(payload) is None:
         await query.answer(ok=False, error_message="Транзакция не найдена")
         return
     await query.answer(ok=True)
@@ -738,63 +3070,242 @@ async def successful_payment(message: types.Message):
     info = message.successful_payment
     payload = info.invoice_payload
     amount = info.total_amount
+    charge_id = info.telegram_payment_charge_id
 
-    if payload not in merchant_transactions:
-        await message.answer("ошибка: транзакция не найдена")
+    # Повторная доставка того же апдейта: платёж уже проведён
+    if processed_charges.get(charge_id):
         return
 
-    data = merchant_transactions[payload]
-    if "link_uuid" in data:
-        await mark_link_used(data["link_uuid"])
-
-    await message.answer(
-        "<tg-emoji emoji-id=\"5206607081334906820\">✅</tg-emoji> оплата прошла успешно! спасибо",
-        message_effect_id=CONFETTI_EFFECT_ID,
-        reply_markup=InlineKeyboardBuilder().add(InlineKeyboardButton(text="в меню", callback_data="back_to_menu")).as_markup(),
-        parse_mode="HTML"
-    )
+    if payload.startswith("direct_inv_"):
+        # Ссылка из пула: отдельного счёта нет, продавец - владелец ссылки
+        data = await get_invoice_link(payload)
+    else:
+        data = await state_backend.get_invoice(payload)
+    if data is None:
+        if await is_payment_processed(charge_id):
+            return
+        await message.answer("ошибка: транзакция не найдена")
+        return
 
     m_id = data["merchant_id"]
-    await add_balance(m_id, amount)
-    
-    if "merchant_msg_id" in data and data["merchant_msg_id"]:
-        # Убрана строка с балансом
-        success_text = (
-            f"<tg-emoji emoji-id=\"5206607081334906820\">✅</tg-emoji> <b>счёт оплачен!</b>\n"
-            f"получено: {amount} <tg-emoji emoji-id=\"5384159397263990339\">⭐</tg-emoji>"
+    # Критический путь: надёжно зачисляем и отвечаем плательщику, остальное - потом и параллельно
+    sale = (message.from_user.id, charge_id, payload, int(time.time()))
+    durable = [add_balance(m_id, amount, sale)]
+    if data.get("link_uuid"):
+        durable.append(mark_link_used(data["link_uuid"]))
+    credited, *_ = await asyncio.gather(*durable)
+    if not credited:
+        # Параллельная доставка уже провела этот платёж и сама ответит плательщику
+        logger.warning(f"Повтор платежа {charge_id} проигнорирован")
+        return
+
+    # Деньги уже зачислены: ошибка ответа плательщику (например, он заблокировал бота)
+    # не должна оставить продавца без уведомления
+    with outbound_priority(PRIORITY_PAYMENT):
+        confirmed, deleted = await asyncio.gather(
+            bot.send_message(
+                message.chat.id,
+                "<tg-emoji emoji-id=\"5206607081334906820\">✅</tg-emoji> оплата прошла успешно! спасибо",
+                message_effect_id=CONFETTI_EFFECT_ID,
+                reply_markup=TO_MENU_KB,
+                parse_mode="HTML"
+            ),
+            state_backend.delete_invoice(payload),
+            return_exceptions=True
         )
-        try:
-            await bot.edit_message_text(chat_id=m_id, message_id=data["merchant_msg_id"], text=success_text, parse_mode="HTML", reply_markup=await main_menu_kb(m_id))
-        except Exception:
-            await bot.send_message(m_id, success_text, parse_mode="HTML", reply_markup=await main_menu_kb(m_id))
+    for name, result in (("подтверждение плательщику", confirmed), ("удаление счёта", deleted)):
+        if isinstance(result, Exception):
+            side_effect_stats["failed"] += 1
+            logger.warning(f"Ошибка: {name}: {result}")
+
+    side_effects = [("уведомление продавца", notify_merchant_paid(m_id, data.get("merchant_msg_id"), amount))]
 
     payer_id = data.get("payer_id")
-    payer_prompt_msg_id = data.get("payer_prompt_msg_id")
-    invoice_msg_id = data.get("invoice_msg_id")
-    if payer_id and payer_prompt_msg_id:
-        with suppress(Exception):
-            await bot.delete_message(chat_id=payer_id, message_id=payer_prompt_msg_id)
-    if payer_id and invoice_msg_id:
-        with suppress(Exception):
-            await bot.delete_message(chat_id=payer_id, message_id=invoice_msg_id)
-
-    if "original_chat_id" in data and "original_msg_id" in data and data["original_chat_id"]:
+    for msg_id in (data.get("payer_prompt_msg_id"), data.get("invoice_msg_id")):
+        if payer_id and msg_id:
+            side_effects.append(("удаление сообщения плательщика", bot.delete_message(chat_id=payer_id, message_id=msg_id)))
+
+    if data.get("original_chat_id") and data.get("original_msg_id"):
+        side_effects.append(("правка исходного сообщения", bot.edit_message_text(
+            chat_id=data["original_chat_id"],
+            message_id=data["original_msg_id"],
+            text="счёт оплачен <tg-emoji emoji-id=\"5206607081334906820\">✅</tg-emoji>",
+            parse_mode="HTML", reply_markup=None
+        )))
+    spawn_side_effects(side_effects)
+
+async def notify_merchant_paid(m_id: int, merchant_msg_id: int, amount: int):
+    # Убрана строка с балансом
+    success_text = (
+        f"<tg-emoji emoji-id=\"5206607081334906820\">✅</tg-emoji> <b>счёт оплачен!</b>\n"
+        f"получено: {amount} {STAR}"
+    )
+    with outbound_priority(PRIORITY_PAYMENT):
+        if merchant_msg_id:
+            try:
+                await bot.edit_message_text(chat_id=m_id, message_id=merchant_msg_id, text=success_text, parse_mode="HTML", reply_markup=MAIN_MENU_KB)
+                return
+            except Exception:
+                pass
+        # Счёт по ссылке из пула: сообщения «ждем оплату» не было, пишем новое
+        await bot.send_message(m_id, success_text, parse_mode="HTML", reply_markup=MAIN_MENU_KB)
+
+# ------------------- WEBHOOK -------------------
+class UpdateScheduler:
+    """Параллельная обработка апдейтов: внутри одного чата порядок сохраняется, общее число задач ограничено."""
+
+    def __init__(self, concurrency: int, max_pending: int):
+        self.workers = asyncio.Semaphore(concurrency)
+        self.pending = asyncio.Semaphore(max_pending)
+        self.chat_tails = {}
+        self.tasks = set()
+        self.latencies = deque(maxlen=10000)
+
+    @staticmethod
+    def chat_key(update: types.Update):
+        event = update.event
+        chat = getattr(event, "chat", None)
+        if chat is not None:
+            return chat.id
+        user = getattr(event, "from_user", None)
+        return user.id if user is not None else update.update_id
+
+    async def submit(self, update: types.Update, timeout: float = 5) -> bool:
+        # Очередь переполнена - не принимаем апдейт, пусть Telegram доставит его повторно
         try:
-            await bot.edit_message_text(
-                chat_id=data["original_chat_id"],
-                message_id=data["original_msg_id"],
-                text="счёт оплачен <tg-emoji emoji-id=\"5206607081334906820\">✅</tg-emoji>",
-                parse_mode="HTML", reply_markup=None
-            )
-        except Exception:
-            pass
-    del merchant_transactions[payload]
+            await asyncio.wait_for(self.pending.acquire(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        key = self.chat_key(update)
+        task = asyncio.create_task(self._process(update, self.chat_tails.get(key), key))
+        self.chat_tails[key] = task
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return True
+
+    async def _process(self, update: types.Update, previous, key):
+        try:
+            if previous is not None:
+                await asyncio.wait({previous})
+            async with self.workers:
+                started = time.perf_counter()
+                await dp.feed_update(bot, update)
+                self.latencies.append(time.perf_counter() - started)
+        except Exception as e:
+            logger.error(f"Ошибка обработки апдейта {update.update_id}: {e}")
+        finally:
+            self.pending.release()
+            if self.chat_tails.get(key) is asyncio.current_task():
+                del self.chat_tails[key]
+
+    async def drain(self):
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+
+update_scheduler = UpdateScheduler(WEBHOOK_CONCURRENCY, WEBHOOK_MAX_PENDING)
+
+async def handle_webhook(request: web.Request) -> web.Response:
+    if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+        return web.Response(status=401)
+    update = types.Update.model_validate(await request.json(), context={"bot": bot})
+    if not await update_scheduler.submit(update):
+        return web.Response(status=503)
+    return web.Response()
+
+def create_webhook_app() -> web.Application:
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle_webhook)
+    return app
+
+# --- Экспорт метрик ---
+def runtime_metrics():
+    # Счётчики, которые компоненты и так ведут у себя, отдаём как есть в момент выгрузки
+    cache = user_cache.stats()
+    lines = []
+    lines += gauge_lines("platilka_user_cache_hits_total", "Попадания в кэш профилей", cache["hits"], "counter")
+    lines += gauge_lines("platilka_user_cache_misses_total", "Промахи кэша профилей", cache["misses"], "counter")
+    lines += gauge_lines("platilka_user_cache_coalesced_total", "Склеенные промахи кэша профилей", cache["coalesced"], "counter")
+    lines += gauge_lines("platilka_user_cache_size", "Записей в кэше профилей", cache["size"])
+    if STATE_BACKEND == "memory":
+        lines += gauge_lines("platilka_fsm_cache_size", "FSM-состояний в памяти", len(fsm_storage.cache))
+        lines += gauge_lines("platilka_fsm_dirty", "FSM-состояний ждут записи в БД", len(fsm_storage.dirty))
+    lines += gauge_lines("platilka_antiflood_keys", "Счётчиков антифлуда в памяти", len(antiflood.limiter))
+    lines += gauge_lines("platilka_user_names_cached", "Имён пользователей в памяти", len(user_names.cache))
+    lines += ["# HELP platilka_side_effects_total Фоновые действия после оплаты", "# TYPE platilka_side_effects_total counter"]
+    for outcome, value in side_effect_stats.items():
+        lines.append(f"platilka_side_effects_total{format_labels(('outcome',), (outcome,))} {value}")
+    lines += gauge_lines("platilka_outbound_retry_after_total", "Повторы исходящих после RetryAfter", outbound_scheduler.stats["retry_after"], "counter")
+    lines += gauge_lines("platilka_outbound_coalesced_total", "Склеенные правки сообщений", outbound_scheduler.stats["coalesced"], "counter")
+    lines += gauge_lines("platilka_balance_queue_size", "Начислений в очереди группового коммита", balance_writer.queue.qsize())
+    lines += ["# HELP platilka_outbox_total Доставка уведомлений из outbox", "# TYPE platilka_outbox_total counter"]
+    for outcome, value in outbox_stats.items():
+        lines.append(f"platilka_outbox_total{format_labels(('outcome',), (outcome,))} {value}")
+    return lines
+
+metrics_collectors.append(runtime_metrics)
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(text=render_metrics(), content_type="text/plain", charset="utf-8")
+
+async def start_metrics_server():
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    return runner
+
+async def run_webhook():
+    runner = web.AppRunner(create_webhook_app())
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    await bot.set_webhook(
+        f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET or None,
+        allowed_updates=dp.resolve_used_update_types(),
+        drop_pending_updates=True
+    )
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+        await update_scheduler.drain()
 
 async def main():
     await init_db()
-    await bot.delete_webhook(drop_pending_updates=True)
+    balance_writer.start()
+    await state_backend.start()
+    if STATE_BACKEND == "memory":
+        fsm_storage.start()
+    await load_used_links_bloom()
+    start_background(outbox_dispatcher())
+    await resume_broadcasts()
+    if INLINE_DIRECT_LINKS:
+        start_background(expire_invoice_links())
+        start_background(invoice_link_pool.run())
+    start_background(antiflood.run_evictor())
+    start_background(user_names.run())
+    if USED_LINKS_RETENTION_DAYS:
+        start_background(prune_used_links())
+    metrics_runner = await start_metrics_server() if METRICS_ENABLED else None
     logger.info("бот работает..")
-    await dp.start_polling(bot)
+    try:
+        if RUN_MODE == "webhook":
+            await run_webhook()
+        else:
+            await bot.delete_webhook(drop_pending_updates=True)
+            await dp.start_polling(bot)
+    finally:
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        await stop_background()
+        await balance_writer.stop()
+        await user_names.flush()
+        await invoice_link_pool.flush()
+        if STATE_BACKEND == "memory":
+            await pending_invoice_writer.flush()
+            await fsm_storage.close()
+        await db_pool.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
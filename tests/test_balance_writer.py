@@ -0,0 +1,101 @@
+import asyncio
+import os
+import sys
+import time
+
+import pytest
+
+os.environ.setdefault("BOT_TOKEN", "123456:test")
+os.environ.setdefault("ADMIN_ID", "1")
+os.environ.setdefault("BOT_USERNAME", "test_bot")
+os.environ.setdefault("METRICS_ENABLED", "0")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+MERCHANT_ID = 10
+PAYER_ID = 20
+AMOUNT = 50
+
+
+@pytest.fixture
+def writer(tmp_path, monkeypatch):
+    # Свежие пул и писатель на каждый тест: asyncio-примитивы привязываются к своему циклу
+    monkeypatch.setattr(main, "db_pool", main.DBPool(str(tmp_path / "bot.db"), readers=1))
+    # Окно пошире, чтобы одновременные submit гарантированно попали в один батч
+    monkeypatch.setattr(main, "balance_writer", main.BalanceWriter(window=0.05))
+    monkeypatch.setattr(main, "processed_charges", main.TTLCache(1000, 86400))
+    return main.balance_writer
+
+
+def run(writer, scenario):
+    async def go():
+        await main.init_db()
+        writer.start()
+        try:
+            return await scenario()
+        finally:
+            await writer.stop()
+            await main.db_pool.close()
+    return asyncio.run(go())
+
+
+def sale(charge_id: str) -> tuple:
+    return (PAYER_ID, charge_id, f"inv_{charge_id}", int(time.time()))
+
+
+async def ledger() -> tuple:
+    async with main.db_pool.read() as db:
+        async with db.execute("SELECT balance FROM users WHERE user_id = ?", (MERCHANT_ID,)) as cursor:
+            (balance,) = await cursor.fetchone()
+        async with db.execute("SELECT COUNT(*) FROM payments") as cursor:
+            (payments,) = await cursor.fetchone()
+        async with db.execute("SELECT COUNT(*) FROM merchant_sales_daily WHERE sales > 0") as cursor:
+            (days,) = await cursor.fetchone()
+        async with db.execute("SELECT SUM(sales) FROM merchant_sales_daily") as cursor:
+            (sales,) = await cursor.fetchone()
+    return balance, payments, days, sales
+
+
+def test_duplicate_charge_in_one_batch_is_credited_once(writer):
+    async def scenario():
+        results = await asyncio.gather(
+            main.add_balance(MERCHANT_ID, AMOUNT, sale("charge_1")),
+            main.add_balance(MERCHANT_ID, AMOUNT, sale("charge_1")),
+        )
+        return results, await ledger()
+
+    results, (balance, payments, days, sales) = run(writer, scenario)
+    assert sorted(results) == [False, True]
+    assert balance == AMOUNT
+    assert payments == 1
+    assert (days, sales) == (1, 1)
+
+
+def test_redelivered_charge_in_later_batch_is_rejected(writer):
+    async def scenario():
+        first = await main.add_balance(MERCHANT_ID, AMOUNT, sale("charge_1"))
+        second = await main.add_balance(MERCHANT_ID, AMOUNT, sale("charge_1"))
+        return first, second, await main.is_payment_processed("charge_1"), await ledger()
+
+    first, second, processed, (balance, payments, days, sales) = run(writer, scenario)
+    assert first is True
+    assert second is False
+    assert processed
+    assert balance == AMOUNT
+    assert payments == 1
+    assert (days, sales) == (1, 1)
+
+
+def test_distinct_charges_in_one_batch_are_all_credited(writer):
+    async def scenario():
+        results = await asyncio.gather(*(
+            main.add_balance(MERCHANT_ID, AMOUNT, sale(f"charge_{i}")) for i in range(3)
+        ))
+        return results, await ledger()
+
+    results, (balance, payments, days, sales) = run(writer, scenario)
+    assert results == [True, True, True]
+    assert balance == 3 * AMOUNT
+    assert payments == 3
+    assert (days, sales) == (1, 3)